@@ -0,0 +1,471 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from twisted.internet import defer, task
+from pyspades.bytes import ByteWriter
+from pyspades.common import Vertex3
+from pyspades.vxl import VXLData
+from PIL import Image
+
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+if SCRIPTS_DIRECTORY not in sys.path:
+    sys.path.append(SCRIPTS_DIRECTORY)
+
+import carGame
+import gif_player
+import tetris
+import tetris_engine
+from tetris_arena import TetrisArena
+from tetris_stats import tetris_stats
+from display_scheduler import scheduler
+from outbound_queue import get_outbound_queue
+
+# Headless benchmarks for the display scripts, no server needed
+# Not a script for piqueserver: run it with python benchmark.py [--json results.json] [--compare old_results.json]
+# Every scenario is seeded, so two runs with the same seed and tick count do the same work and their results can be compared
+
+DEFAULT_SEED = 1
+DEFAULT_TICKS = 500
+DEFAULT_PLAYERS = 8  # Half of them stand close to the displays, the other half out of view distance
+DEFAULT_TOLERANCE = 0.1  # A metric getting 10% worse than in the compared run is reported as a regression
+
+BENCHMARK_GIF_SIZE = (320, 240)
+BENCHMARK_GIF_FRAMES = 48
+BENCHMARK_GIF_SCALE = 4
+BENCHMARK_ENGINE_STEPS = 200  # Random inputs per headless tetris game
+BENCHMARK_ARENA_BOARDS = 16
+
+DISPLAY_POSITION = (256, 256, 50)  # Every display is built around here
+
+# metric -> True if higher is better
+METRICS = {
+    "ticks_per_sec": True,
+    "packets_per_tick": False,
+    "bytes_per_tick": False,
+    "load_secs": False,
+    "peak_memory_kb": False,
+}
+
+
+class FakeWorldObject:
+    def __init__(self, position: tuple[float, float, float]) -> None:
+        self.position = Vertex3(*position)
+        self.left = self.right = self.up = self.down = False
+        self.dead = False
+
+
+class FakeProtocol:
+    def __init__(self, *args, **kwargs) -> None:
+        self.players = {}
+        self.connections = {}
+        self.map = VXLData()
+
+        self.packets = 0
+        self.bytes = 0
+
+    def broadcast_contained(self, contained, unsequenced=False, sender=None, team=None, save=False, rule=None) -> None:
+        writer = ByteWriter()
+        contained.write(writer)
+        size = len(bytes(writer))
+
+        # Counted per receiving player, like the server's outbound traffic
+        for player in self.connections.values():
+            if player is sender or (rule is not None and not rule(player)):
+                continue
+
+            self.packets += 1
+            self.bytes += size
+
+    def broadcast_chat(self, message, *args, **kwargs) -> None:
+        pass
+
+
+class FakeConnection:
+    saved_loaders = None
+    admin = True
+
+    def __init__(self, protocol, player_id: int, position: tuple[float, float, float]) -> None:
+        self.protocol = protocol
+        self.player_id = player_id
+        self.name = f"player{player_id}"
+        self.team = None
+        self.world_object = FakeWorldObject(position)
+
+        protocol.players[player_id] = self
+        protocol.connections[player_id] = self
+
+    def send_contained(self, contained, *args, **kwargs) -> None:
+        writer = ByteWriter()
+        contained.write(writer)
+
+        self.protocol.packets += 1
+        self.protocol.bytes += len(bytes(writer))
+
+    def send_chat(self, message, *args, **kwargs) -> None:
+        pass
+
+    def get_location(self) -> tuple[float, float, float]:
+        return self.world_object.position.get()
+
+    def set_location_safe(self, location) -> None:
+        self.world_object.position.set(*location)
+
+    def on_spawn(self, pos) -> None:
+        pass
+
+    def on_join(self) -> None:
+        pass
+
+    def on_disconnect(self) -> None:
+        pass
+
+
+def create_players(protocol, connection_class, players: int) -> list:
+    connections = []
+
+    for player_id in range(players):
+        if player_id % 2 == 0:
+            offset = (random.uniform(-20, 20), random.uniform(-20, 20), 0)
+        else:
+            offset = (random.uniform(200, 250), random.uniform(200, 250), 0)
+
+        position = tuple(DISPLAY_POSITION[axis] + offset[axis] for axis in range(3))
+        connections.append(connection_class(protocol, player_id, position))
+
+    return connections
+
+
+def create_benchmark_gif(directory: str) -> str:
+    # Moving gradient with some noise: big smooth areas plus pixels changing every frame, like most real gifs
+    file_path = os.path.join(directory, "benchmark.gif")
+    width, height = BENCHMARK_GIF_SIZE
+    frames = []
+
+    for frame_idx in range(BENCHMARK_GIF_FRAMES):
+        image = Image.new("RGB", (width, height))
+        image.putdata([
+            ((x + frame_idx * 4) % 256, (y * 2) % 256, random.randint(0, 255) if (x * y + frame_idx) % 7 == 0 else 128)
+            for y in range(height) for x in range(width)
+        ])
+        frames.append(image)
+
+    frames[0].save(file_path, save_all=True, append_images=frames[1:], duration=100, loop=0)
+    return file_path
+
+
+@defer.inlineCallbacks
+def load_gif(directory: str, players: int, cached: bool):
+    # Returns the protocol, the loaded gif and how long loading took
+    protocol_class, connection_class = gif_player.apply_script(FakeProtocol, FakeConnection, None)
+    protocol = protocol_class()
+    connections = create_players(protocol, connection_class, players)
+
+    gif_player.GIF_CACHE_DIRECTORY = os.path.join(directory, "cache")
+    if not cached:
+        shutil.rmtree(gif_player.GIF_CACHE_DIRECTORY, ignore_errors=True)
+
+    start = time.perf_counter()
+    gif = gif_player.Gif(os.path.join(directory, "benchmark.gif"), connections[0], scale=BENCHMARK_GIF_SCALE)
+    yield gif.loading
+    load_secs = time.perf_counter() - start
+
+    # Ticked by hand from now on, with someone watching so it doesn't pause itself
+    if gif.loop.running:
+        gif.loop.stop()
+
+    connections[0].world_object.position.set(gif.center_x, gif.center_y, gif.center_z)
+
+    return protocol, gif, load_secs
+
+
+@defer.inlineCallbacks
+def setup_tetris(directory: str, players: int):
+    protocol_class, connection_class = tetris.apply_script(FakeProtocol, FakeConnection, None)
+    protocol = protocol_class()
+    connections = create_players(protocol, connection_class, players)
+
+    player = connections[0]
+    player.on_spawn(None)
+
+    def tick() -> None:
+        # Game overs stop the game, the player starts a new one right away
+        if player.game is None:
+            player.create_tetris(*DISPLAY_POSITION)
+            player.loop.stop()
+
+        # One gravity step, sometimes after a move of the player
+        move = random.randint(0, 4)
+        if move == 0:
+            player.move_left()
+            player.refresh_after_input()
+        elif move == 1:
+            player.move_right()
+            player.refresh_after_input()
+        elif move == 2:
+            player.rotate_piece()
+            player.refresh_after_input()
+
+        player.game_tick()
+
+    yield None
+    return protocol, tick, None, None
+
+
+@defer.inlineCallbacks
+def setup_tetris_arena(directory: str, players: int):
+    protocol_class, connection_class = tetris.apply_script(FakeProtocol, FakeConnection, None)
+    protocol = protocol_class()
+    connections = create_players(protocol, connection_class, max(players, BENCHMARK_ARENA_BOARDS))
+
+    arena = protocol.tetris_arena = TetrisArena(protocol, DISPLAY_POSITION)
+    for player in connections[:BENCHMARK_ARENA_BOARDS]:
+        arena.join(player)
+
+    def tick() -> None:
+        # One arena tick after a random move on every board, a new round starts when one ends
+        if not arena.running:
+            arena.start()
+            arena.loop.stop()
+
+        for player in connections[:BENCHMARK_ARENA_BOARDS]:
+            move = random.randint(0, 9)
+            if move == 0:
+                player.move_left()
+            elif move == 1:
+                player.move_right()
+            elif move == 2:
+                player.rotate_piece()
+
+        arena.tick()
+
+    yield None
+    return protocol, tick, None, arena.delete
+
+
+@defer.inlineCallbacks
+def setup_tetris_engine(directory: str, players: int):
+    # No display at all, every tick plays a whole headless game
+    protocol = FakeProtocol()
+
+    def tick() -> None:
+        tetris_engine.simulate_games(1, BENCHMARK_ENGINE_STEPS, seed=random.getrandbits(32))
+
+    yield None
+    return protocol, tick, None, None
+
+
+@defer.inlineCallbacks
+def setup_car_game(directory: str, players: int):
+    protocol_class, connection_class = carGame.apply_script(FakeProtocol, FakeConnection, None)
+    protocol = protocol_class()
+    connections = create_players(protocol, connection_class, players)
+
+    player = connections[0]
+    protocol.init_new_game(player.player_id)
+    protocol.tick_call.stop()
+    protocol.join_player(player.player_id)
+    protocol.start_game()
+
+    def tick() -> None:
+        player.world_object.left = random.randint(0, 9) == 0
+        player.world_object.right = random.randint(0, 9) == 0
+        player.world_object.up = random.randint(0, 1) == 0
+        protocol.tick()
+
+    yield None
+    return protocol, tick, None, protocol.delete_game
+
+
+@defer.inlineCallbacks
+def setup_gif_render(directory: str, players: int, packet_budget: int = 0):
+    protocol, gif, _ = yield load_gif(directory, players, cached=True)
+    gif.packet_budget = packet_budget
+    return protocol, gif.update, None, gif.kill
+
+
+@defer.inlineCallbacks
+def setup_gif_render_budget(directory: str, players: int):
+    result = yield setup_gif_render(directory, players, packet_budget=200)
+    return result
+
+
+@defer.inlineCallbacks
+def setup_gif_load_cold(directory: str, players: int):
+    protocol, gif, load_secs = yield load_gif(directory, players, cached=False)
+    gif.kill()
+    return protocol, None, load_secs, None
+
+
+@defer.inlineCallbacks
+def setup_gif_load_cached(directory: str, players: int):
+    # Makes sure the cache exists, then times loading from it
+    _, gif, _ = yield load_gif(directory, players, cached=True)
+    gif.kill()
+
+    protocol, gif, load_secs = yield load_gif(directory, players, cached=True)
+    gif.kill()
+    return protocol, None, load_secs, None
+
+
+SCENARIOS = {
+    "tetris": setup_tetris,
+    "tetris_arena": setup_tetris_arena,
+    "tetris_engine": setup_tetris_engine,
+    "car_game": setup_car_game,
+    "gif_render": setup_gif_render,
+    "gif_render_budget": setup_gif_render_budget,
+    "gif_load_cold": setup_gif_load_cold,
+    "gif_load_cached": setup_gif_load_cached,
+}
+
+
+@defer.inlineCallbacks
+def run_scenario(name: str, directory: str, seed: int, ticks: int, players: int, trace_memory: bool):
+    random.seed(seed)
+    if trace_memory:
+        tracemalloc.start()
+
+    # Scenarios return (protocol, tick function or None, load time or None, cleanup function or None)
+    protocol, tick, load_secs, cleanup = yield SCENARIOS[name](directory, players)
+    protocol.packets = protocol.bytes = 0
+    results = {}
+
+    if tick is not None:
+        start = time.perf_counter()
+        for _ in range(ticks):
+            # The scheduler isn't running, its clock is advanced by hand so per tick caches (player grid) behave like on a server
+            scheduler.ticks += 1
+            tick()
+
+            # The reactor isn't ticking the outbound queue either, it is emptied after every tick so all the traffic is counted
+            queue = get_outbound_queue(protocol)
+            while queue.blocks or queue.chats:
+                queue.tick()
+
+        elapsed = time.perf_counter() - start
+        results["ticks_per_sec"] = ticks / elapsed
+        results["packets_per_tick"] = protocol.packets / ticks
+        results["bytes_per_tick"] = protocol.bytes / ticks
+
+    if load_secs is not None:
+        results["load_secs"] = load_secs
+
+    # Displays left behind would share their state (gif frames) with the next scenarios
+    if cleanup is not None:
+        cleanup()
+
+    if trace_memory:
+        results = {"peak_memory_kb": tracemalloc.get_traced_memory()[1] / 1024}
+        tracemalloc.stop()
+
+    return results
+
+
+@defer.inlineCallbacks
+def run_benchmarks(names: list, seed: int, ticks: int, players: int):
+    directory = tempfile.mkdtemp(prefix="display_benchmark_")
+    results = {}
+
+    # The benchmark games are counted in the tetris stats, they must not end up in the server's file
+    tetris_stats.file_path = os.path.join(directory, "tetris_stats.json")
+
+    try:
+        random.seed(seed)
+        create_benchmark_gif(directory)
+
+        for name in names:
+            # Timed without tracemalloc, it slows everything down. Peak memory comes from a second identical run
+            results[name] = yield run_scenario(name, directory, seed, ticks, players, trace_memory=False)
+            memory = yield run_scenario(name, directory, seed, ticks, players, trace_memory=True)
+            results[name].update(memory)
+
+            print_results(name, results[name])
+    finally:
+        yield tetris_stats.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+
+def print_results(name: str, results: dict) -> None:
+    print(f"{name:<20}" + "  ".join(f"{metric} {value:.6g}" for metric, value in results.items()))
+
+
+def compare_results(old: dict, new: dict, tolerance: float) -> list:
+    regressions = []
+
+    for name, results in new["scenarios"].items():
+        old_results = old["scenarios"].get(name)
+        if old_results is None:
+            continue
+
+        for metric, value in results.items():
+            old_value = old_results.get(metric)
+            if not old_value:
+                continue
+
+            change = (value - old_value) / old_value
+            worse = -change if METRICS[metric] else change
+            print(f"{name:<20}{metric:<18}{old_value:>12.6g} -> {value:<12.6g}{change:+.1%}")
+
+            if worse > tolerance:
+                regressions.append((name, metric, old_value, value))
+
+    return regressions
+
+
+@defer.inlineCallbacks
+def main(reactor, args):
+    scenarios = yield run_benchmarks(args.scenarios, args.seed, args.ticks, args.players)
+    results = {
+        "seed": args.seed,
+        "ticks": args.ticks,
+        "players": args.players,
+        "python": platform.python_version(),
+        "scenarios": scenarios,
+    }
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=4)
+
+    if args.compare:
+        with open(args.compare) as file:
+            old = json.load(file)
+
+        if (old["seed"], old["ticks"], old["players"]) != (args.seed, args.ticks, args.players):
+            print("Warning: the compared run used a different seed, tick count or player count")
+
+        regressions = compare_results(old, results, args.tolerance)
+        for name, metric, old_value, value in regressions:
+            print(f"Regression: {name} {metric} {old_value:.6g} -> {value:.6g}")
+
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless benchmarks for the display scripts")
+    parser.add_argument("scenarios", nargs="*", default=list(SCENARIOS), help=f"Scenarios to run, all of them by default: {', '.join(SCENARIOS)}")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--ticks", type=int, default=DEFAULT_TICKS)
+    parser.add_argument("--players", type=int, default=DEFAULT_PLAYERS)
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Results file of an earlier run to compare with, exits with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+
+    args = parser.parse_args()
+
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}")
+
+    task.react(main, [args])
@@ -0,0 +1,190 @@
+from weakref import WeakKeyDictionary
+
+from pyspades.contained import BlockAction, BlockLine, SetColor
+from pyspades.common import make_color
+from pyspades.constants import BUILD_BLOCK, DESTROY_BLOCK, SPADE_DESTROY
+
+from perf_stats import get_packet_size
+from outbound_queue import get_outbound_queue, PRIORITY_DECORATION
+
+# Shared block emitter for the display scripts (gif player, car game, tetris)
+# Like the other shared helpers next to it (framebuffer, outbound_queue, perf_stats, ...) this is not a piqueserver script.
+# piqueserver doesn't put the scripts directory on sys.path, so the scripts using the helpers append it before importing them
+# Block writes are queued during a frame and sent grouped by color once flush()ed and let through by the outbound queue,
+# so a SetColor is only sent when the color actually changes instead of before every single BlockAction.
+# Straight runs of the same color are sent as one BlockLine and stacks of 3 destroyed blocks as one spade hit
+
+DISPLAY_PLAYER_ID = 32  # Fake player the display blocks are built by
+MAX_BLOCK_LINE_LENGTH = 50  # Clients stop drawing a block line after 50 blocks
+
+LINE_DIRECTIONS = ((0, 0, 1), (1, 0, 0), (0, 1, 0))
+
+# Blocks built by any display and not destroyed since, per protocol. They are not in the server's map
+display_blocks = WeakKeyDictionary()
+
+
+class BlockEmitter:
+    def __init__(self, protocol, player_id: int = DISPLAY_PLAYER_ID, connection=None) -> None:
+        self.protocol = protocol
+        self.player_id = player_id
+        self.connection = connection  # Only send to this player instead of broadcasting
+        self.viewers = None  # If set, only players in this set get the blocks
+        self.perf = None  # DisplayStats counting what is sent
+        self.priority = PRIORITY_DECORATION  # Outbound queue priority, see outbound_queue
+
+        # Latest write per block wins, so a block changed twice in a frame is only sent once
+        self.builds: dict[tuple[int, int, int], tuple[int, int, int]] = {}
+        self.destroys: set[tuple[int, int, int]] = set()
+
+        self.set_color = SetColor()
+        self.set_color.player_id = self.player_id
+
+        self.block_action = BlockAction()
+        self.block_action.player_id = self.player_id
+
+        self.block_line = BlockLine()
+        self.block_line.player_id = self.player_id
+
+        if connection is not None:
+            # The player's map doesn't have the display blocks other players see
+            self.display_blocks = set()
+        else:
+            if protocol not in display_blocks:
+                display_blocks[protocol] = set()
+            self.display_blocks = display_blocks[protocol]
+
+    def build(self, x: int, y: int, z: int, color: tuple[int, int, int]) -> None:
+        pos = (x, y, z)
+        self.destroys.discard(pos)
+        self.builds[pos] = color
+
+    def destroy(self, x: int, y: int, z: int) -> None:
+        pos = (x, y, z)
+        self.builds.pop(pos, None)
+        self.destroys.add(pos)
+
+    def send(self, contained) -> None:
+        if self.perf is not None:
+            if self.connection is not None:
+                recipients = 1
+            elif self.viewers is not None:
+                recipients = len(self.viewers)
+            else:
+                recipients = len(self.protocol.players)
+
+            self.perf.record_packets(recipients, get_packet_size(contained))
+
+        if self.connection is not None:
+            self.connection.send_contained(contained)
+            return None
+
+        if self.viewers is not None:
+            self.protocol.broadcast_contained(contained, rule=self.viewers.__contains__)
+            return None
+
+        self.protocol.broadcast_contained(contained)
+
+    def send_block_action(self, pos: tuple[int, int, int], value: int) -> None:
+        self.block_action.x, self.block_action.y, self.block_action.z = pos
+        self.block_action.value = value
+        self.send(self.block_action)
+
+    def send_block_line(self, start: tuple[int, int, int], end: tuple[int, int, int]) -> None:
+        self.block_line.x1, self.block_line.y1, self.block_line.z1 = start
+        self.block_line.x2, self.block_line.y2, self.block_line.z2 = end
+        self.send(self.block_line)
+
+    def is_empty(self, pos: tuple[int, int, int]) -> bool:
+        # Clients only fill the empty cells of a block line, so lines can't recolor existing blocks
+        if pos in self.display_blocks:
+            return False
+
+        x, y, z = int(pos[0]), int(pos[1]), int(pos[2])
+        return self.protocol.map.is_valid_position(x, y, z) and not self.protocol.map.get_solid(x, y, z)
+
+    def find_line(self, start: tuple[int, int, int], line_cells: set, done: set) -> list:
+        # Longest run of cells starting at `start` along one axis
+        best_line = [start]
+
+        for dx, dy, dz in LINE_DIRECTIONS:
+            line = [start]
+
+            while len(line) < MAX_BLOCK_LINE_LENGTH:
+                end = line[-1]
+                cell = (end[0] + dx, end[1] + dy, end[2] + dz)
+                if cell not in line_cells or cell in done:
+                    break
+
+                line.append(cell)
+
+            if len(line) > len(best_line):
+                best_line = line
+
+        return best_line
+
+    def flush_destroys(self) -> None:
+        done = set()
+
+        for pos in sorted(self.destroys):
+            if pos in done:
+                continue
+
+            x, y, z = pos
+            above, top = (x, y, z + 1), (x, y, z + 2)
+
+            # SPADE_DESTROY removes the block it hits plus the ones right above and under it
+            if above in self.destroys and top in self.destroys and above not in done and top not in done:
+                self.send_block_action(above, SPADE_DESTROY)
+                done.update((pos, above, top))
+            else:
+                self.send_block_action(pos, DESTROY_BLOCK)
+                done.add(pos)
+
+        self.display_blocks.difference_update(self.destroys)
+
+    def flush_builds(self) -> None:
+        by_color: dict[tuple[int, int, int], list] = {}
+        for pos, color in self.builds.items():
+            by_color.setdefault(color, []).append(pos)
+
+        # The color of the display player is shared by every emitter and unknown to players who joined
+        # since the last flush, so each flush starts by sending its first color
+        for color in sorted(by_color):
+            self.set_color.value = make_color(*color)
+            self.send(self.set_color)
+
+            positions = sorted(by_color[color])
+            line_cells = {pos for pos in positions if self.is_empty(pos)}
+            done = set()
+
+            for pos in positions:
+                if pos in done:
+                    continue
+
+                line = [pos]
+                if pos in line_cells:
+                    line = self.find_line(pos, line_cells, done)
+
+                if len(line) == 1:
+                    self.send_block_action(pos, BUILD_BLOCK)
+                else:
+                    self.send_block_line(line[0], line[-1])
+
+                done.update(line)
+
+        self.display_blocks.update(self.builds)
+
+    def flush(self) -> None:
+        # Broadcasts wait in the protocol's outbound queue, which calls send_queued() when their turn comes
+        if self.connection is None:
+            get_outbound_queue(self.protocol).push_blocks(self)
+            return None
+
+        self.send_queued()
+
+    def send_queued(self) -> None:
+        self.flush_destroys()
+        self.flush_builds()
+
+        self.builds.clear()
+        self.destroys.clear()
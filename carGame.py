@@ -1,10 +1,20 @@
 from piqueserver.commands import command
-from pyspades.contained import SetColor, BlockAction
-from pyspades.common import Vertex3, make_color
-from pyspades.constants import BUILD_BLOCK, DESTROY_BLOCK
-from twisted.internet.task import LoopingCall
+from pyspades.common import Vertex3
 from random import randint
 from math import floor
+import os
+import sys
+
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+if SCRIPTS_DIRECTORY not in sys.path:
+    sys.path.append(SCRIPTS_DIRECTORY)
+
+from block_emitter import BlockEmitter
+from framebuffer import FrameBuffer, send_display_snapshots
+from display_scheduler import ScheduledCall
+from perf_stats import get_display_stats
+from lag_watchdog import watchdog, GAME_FPS_LEVEL
+from outbound_queue import PRIORITY_GAME
 
 
 @command("create_game")
@@ -54,47 +64,23 @@ def start_game(connection):
     connection.protocol.start_game()
     return "Game will start soon. Get ready!"
 
-class Display:
+class Display(FrameBuffer):
     def __init__(self, protocol, position, width = 10, height = 10):
         self.protocol = protocol
         self.position = position
 
-        self.width = width
-        self.height = height
-
-        self.pixels = []
-        self.world_blocks = []
+        super().__init__(width, height, self.to_world, BlockEmitter(protocol))
 
     def init(self):
-        self._generate_blank_display()
         self._pretty_colors()
         self.full_refresh()
 
     def delete(self):
-        for x in range(self.width):
-            for y in range(self.height):
-                action = BlockAction()
-                action.player_id = 32
-                action.x = self.position[0] + x
-                action.y = self.position[1]
-                action.z = self.position[2] - y
-                action.value = DESTROY_BLOCK
-
-                self.protocol.broadcast_contained(action)
-        
+        self.clear()
         self.fill((0, 0, 0))
-    
-    def _generate_blank_display(self):
-        self.pixels = []
-        self.world_blocks = []
-        for x in range(self.width):
-            layer = []
-            for y in range(self.height):
-                
-                layer.append((0, 0, 0))
 
-            self.pixels.append(layer.copy())
-            self.world_blocks.append(layer.copy())
+    def to_world(self, x, y):
+        return (self.position[0] + x, self.position[1], self.position[2] - y)
     
     def _pretty_colors(self):
         for x in range(self.width):
@@ -105,52 +91,6 @@ class Display:
                     128
                 )
 
-                self.pixels[x][y] = color
-
-    def _refresh_pixel(self, pixel_coords: tuple[int, int]):
-        set_color = SetColor()
-        set_color.value = make_color(*self.pixels[pixel_coords[0]][pixel_coords[1]])
-        set_color.player_id = 32
-
-        self.protocol.broadcast_contained(set_color)
-
-        build_action = BlockAction()
-        build_action.x = self.position[0] + pixel_coords[0]
-        build_action.y = self.position[1]
-        build_action.z = self.position[2] - pixel_coords[1]
-        build_action.player_id = 32
-        build_action.value = BUILD_BLOCK
-
-        self.protocol.broadcast_contained(build_action)
-    
-    def refresh(self):
-        for x in range(self.width):
-            for y in range(self.height):
-                if self.pixels[x][y] == self.world_blocks[x][y]:
-                    continue
-
-                self._refresh_pixel((x, y))
-                self.world_blocks[x][y] = self.pixels[x][y]
-
-    def full_refresh(self):
-        for x in range(self.width):
-            for y in range(self.height):
-                self._refresh_pixel((x, y))
-    
-    def set_at(self, x_y, color):
-        if x_y[0] < 0 or x_y[1] < 0 or x_y[0] >= self.width or x_y[1] >= self.height:
-            return None
-
-        self.pixels[x_y[0]][x_y[1]] = color
-    
-    def fill(self, color):
-        for x in range(self.width):
-            for y in range(self.height):
-                self.set_at((x, y), color)
-    
-    def rect(self, rect, color):
-        for x in range(rect[0], rect[0] + rect[2]):
-            for y in range(rect[1], rect[1] + rect[3]):
                 self.set_at((x, y), color)
 
 def apply_script(protocol, connection, config):
@@ -162,7 +102,11 @@ def apply_script(protocol, connection, config):
             self.current_player_id = -1
             self.ticks = 0
 
-            self.tick_call = LoopingCall(self.tick)
+            self.perf = get_display_stats("car_game")
+            self.tick_call = ScheduledCall(self.perf.measure(self.tick, 1 / 30))
+            self.block_emitter = BlockEmitter(self)
+            self.block_emitter.perf = self.perf
+            self.block_emitter.priority = PRIORITY_GAME
 
             self.display = None
 
@@ -171,6 +115,8 @@ def apply_script(protocol, connection, config):
             self.ticks = 0
 
             self.display = Display(self, (self.position[0], self.position[1], self.position[2] - 2), width=31, height=40)
+            self.display.emitter.perf = self.perf
+            self.display.emitter.priority = PRIORITY_GAME
             self.display.init()
             # self.display.fill((255, 0, 255))
 
@@ -215,6 +161,7 @@ def apply_script(protocol, connection, config):
             self.build_block((self.position[0] + self.display.width // 2 - 1, self.position[1] + self.display.height, self.position[2] + 2), (255, 255, 255))
             self.build_block((self.position[0] + self.display.width // 2, self.position[1] + self.display.height + 1, self.position[2] + 2), (255, 255, 255))
             self.build_block((self.position[0] + self.display.width // 2, self.position[1] + self.display.height - 1, self.position[2] + 2), (255, 255, 255))
+            self.block_emitter.flush()
             
             self.set_player_position()
         
@@ -347,19 +294,7 @@ def apply_script(protocol, connection, config):
                 del self.cars[car_idx]
         
         def build_block(self, pos, color):
-            set_color = SetColor()
-            set_color.player_id = 32
-            set_color.value = make_color(*color)
-            self.broadcast_contained(set_color)
-
-            action = BlockAction()
-            action.player_id = 32
-            action.value = BUILD_BLOCK
-            action.x = pos[0]
-            action.y = pos[1]
-            action.z = pos[2]
-
-            self.broadcast_contained(action)
+            self.block_emitter.build(pos[0], pos[1], pos[2], color)
         
         def tick(self):
             self.handle_player_movement()
@@ -367,8 +302,15 @@ def apply_script(protocol, connection, config):
             if self.current_player_id != -1:
                 self.render_screen()
 
-            self.display.refresh()
+            # The game keeps its speed under lag, only the screen updates less often
+            if not watchdog.skip_frame(GAME_FPS_LEVEL, self.ticks):
+                self.display.refresh()
 
             self.ticks += 1
 
-    return CarGameProtocol, connection
\ No newline at end of file
+    class CarGameConnection(connection):
+        def on_join(self):
+            send_display_snapshots(self)
+            return connection.on_join(self)
+
+    return CarGameProtocol, CarGameConnection
\ No newline at end of file
@@ -1,6 +1,14 @@
 from piqueserver import *
 from piqueserver.commands import command
 from twisted.internet.task import LoopingCall
+import os
+import sys
+
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+if SCRIPTS_DIRECTORY not in sys.path:
+    sys.path.append(SCRIPTS_DIRECTORY)
+
+from perf_stats import get_display_stats, remove_display_stats
 
 """
 Countdown script by Gato :D
@@ -116,9 +124,12 @@ def apply_script(protocol, connection, config):
                 self.send_msg(f"{self.secs_to_text(self.current_time)} left")
         
         def send_msg(self, msg: str):
+            # Chat packets are the message plus 4 bytes (packet id, player id, chat type, string end)
             if self.public:
+                self.perf.record_packets(len(self.protocol.players), len(msg) + 4)
                 self.protocol.broadcast_chat(msg)
             else:
+                self.perf.record_packets(1, len(msg) + 4)
                 self.send_chat(msg)
 
         def on_countdow_end(self) -> None:
@@ -126,10 +137,12 @@ def apply_script(protocol, connection, config):
             self.call.stop()
 
             self.currently_active = False
+            remove_display_stats(self.perf.name)
 
         def start_countdown(self) -> None:
+            self.perf = get_display_stats(f"countdown-{self.player_id}")
             self.send_msg(f"Started a {'public' if self.public else 'private'} countdown of {self.secs_to_text(self.current_time)}")
-            self.call = LoopingCall(self.tick)
+            self.call = LoopingCall(self.perf.measure(self.tick, 1.0))
 
             self.call.start(1.0)
 
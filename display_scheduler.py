@@ -0,0 +1,105 @@
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
+
+from lag_watchdog import watchdog
+
+# Server-wide scheduler for the display scripts (gif player, car game, tetris)
+# Every display is ticked from one LoopingCall running at SCHEDULER_RATE, each one at an integer divisor of it.
+# Displays sharing a divisor are spread over its phases so their bursts of packets don't land on the same tick
+
+SCHEDULER_RATE = 60  # Base ticks per second, a display asking for 0.1 secs runs every 6 base ticks
+
+log = Logger()
+
+
+class ScheduledCall:
+    # Drop-in replacement for LoopingCall, ticked by the shared scheduler instead of its own timer
+    def __init__(self, f, *args, **kwargs) -> None:
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+
+        self.running = False
+        self.interval = None
+        self.divisor = 1
+        self.phase = 0
+
+    def start(self, interval: float, now: bool = True) -> None:
+        if self.running:
+            raise RuntimeError("Tried to start an already running ScheduledCall")
+
+        self.interval = interval
+        self.running = True
+        scheduler.add(self)
+
+        # Like LoopingCall, the first call happens right away unless now=False
+        if now:
+            self()
+
+    def stop(self) -> None:
+        if not self.running:
+            raise RuntimeError("Tried to stop a ScheduledCall that was not running")
+
+        self.running = False
+        scheduler.remove(self)
+
+    def __call__(self) -> None:
+        self.f(*self.args, **self.kwargs)
+
+
+class DisplayScheduler:
+    def __init__(self, rate: int = SCHEDULER_RATE) -> None:
+        self.rate = rate
+        self.ticks = 0
+        self.calls: list[ScheduledCall] = []
+
+        self.loop = LoopingCall.withCount(self.tick)
+
+    def add(self, call: ScheduledCall) -> None:
+        call.divisor = max(1, round(call.interval * self.rate))
+
+        # Pick the least crowded phase among the displays running at the same rate
+        phase_load = [0] * call.divisor
+        for other in self.calls:
+            if other.divisor == call.divisor:
+                phase_load[other.phase] += 1
+
+        call.phase = phase_load.index(min(phase_load))
+        self.calls.append(call)
+
+        if not self.loop.running:
+            # Per tick caches (player grid) built before the scheduler stopped are stale, a new tick invalidates them
+            self.ticks += 1
+            self.loop.start(1 / self.rate, now=False)
+            watchdog.start()
+
+    def remove(self, call: ScheduledCall) -> None:
+        if call in self.calls:
+            self.calls.remove(call)
+
+        if not self.calls and self.loop.running:
+            self.loop.stop()
+            watchdog.stop()
+
+    def tick(self, elapsed: int) -> None:
+        # `elapsed` is more than 1 when the reactor fell behind: a display that was due during the missed ticks
+        # runs once now instead of once per missed tick, and the clock stays aligned to real time
+        previous_ticks = self.ticks
+        self.ticks += elapsed
+
+        for call in list(self.calls):
+            if not call.running:
+                continue
+
+            if (self.ticks - call.phase) // call.divisor == (previous_ticks - call.phase) // call.divisor:
+                continue
+
+            try:
+                call()
+            except Exception:
+                log.failure("Display tick failed, stopping it")
+                if call.running:
+                    call.stop()
+
+
+scheduler = DisplayScheduler()
@@ -0,0 +1,241 @@
+# Shared framebuffer for the display scripts (gif player, car game, tetris)
+# Colors are kept 3 bytes per pixel in screen order (x * height + y): `pixels` is what the display should show,
+# `world` is what players currently see. Writes mark pixels dirty and refresh() only visits those
+# Players joining later get the built pixels of every open framebuffer once, see send_display_snapshots()
+# With a view distance, updates only go to the players close enough and the others catch up when they come closer
+
+from weakref import WeakKeyDictionary, WeakSet
+
+from block_emitter import BlockEmitter
+from player_grid import get_player_grid
+from lag_watchdog import watchdog, FAR_DISPLAYS_LEVEL, FAR_DISPLAY_DISTANCE
+from outbound_queue import PRIORITY_DECORATION
+
+DISPLAY_VIEW_DISTANCE = 128  # Blocks from the display center, players can't see past the fog anyway. 0 sends to everyone
+DISPLAY_VIEW_EXIT_MARGIN = 1.1  # Viewers only leave past view_distance times this, so walking along the edge doesn't resend the display
+
+# Framebuffers whose blocks are in the world, per protocol
+open_framebuffers = WeakKeyDictionary()
+
+# Connections that already got the display snapshots
+synced_connections = WeakSet()
+
+
+class FrameBuffer:
+    def __init__(self, width: int, height: int, to_world, emitter, color: tuple[int, int, int] = (0, 0, 0), world_color: tuple[int, int, int] = None, view_distance: float = DISPLAY_VIEW_DISTANCE) -> None:
+        self.width = width
+        self.height = height
+        self.emitter = emitter
+        self.view_distance = view_distance
+
+        self.pixels = bytearray(width * height * 3)
+        self.world = bytearray(width * height * 3)
+
+        # 1 for every pixel sent to the world at least once, only those are part of the snapshot
+        self.built = bytearray(width * height)
+
+        self.open(to_world, color, world_color)
+
+    def open(self, to_world, color: tuple[int, int, int] = (0, 0, 0), world_color: tuple[int, int, int] = None, emitter=None) -> None:
+        # Also reuses a closed framebuffer somewhere else, its buffers are kept.
+        # A new emitter is needed then, blocks of the old place may still wait in the outbound queue with the old one
+        self.to_world = to_world  # (x, y) -> world block position
+        if emitter is not None:
+            self.emitter = emitter
+
+        if self.view_distance > 0:
+            self.emitter.viewers = set()
+
+        if world_color is None:
+            world_color = color
+
+        self.pixels[:] = bytes(color) * (self.width * self.height)
+        self.world[:] = bytes(world_color) * (self.width * self.height)
+        self.built[:] = bytes(self.width * self.height)
+
+        # Players who saw the display once, they keep its blocks while away
+        self.former_viewers = WeakSet()
+
+        # Invariant: every pixel outside of `dirty` is shown in the world (within the refresh threshold)
+        self.dirty: set[int] = set(range(self.width * self.height)) if color != world_color else set()
+
+        if self.emitter.protocol not in open_framebuffers:
+            open_framebuffers[self.emitter.protocol] = WeakSet()
+        open_framebuffers[self.emitter.protocol].add(self)
+
+    def get_at(self, x_y) -> tuple[int, int, int]:
+        offset = (x_y[0] * self.height + x_y[1]) * 3
+        return tuple(self.pixels[offset:offset + 3])
+
+    def set_index(self, pixel_idx: int, color) -> None:
+        offset = pixel_idx * 3
+        pixels = self.pixels
+
+        if pixels[offset] == color[0] and pixels[offset + 1] == color[1] and pixels[offset + 2] == color[2]:
+            return None
+
+        pixels[offset:offset + 3] = color
+        self.dirty.add(pixel_idx)
+
+    def set_at(self, x_y, color) -> None:
+        if x_y[0] < 0 or x_y[1] < 0 or x_y[0] >= self.width or x_y[1] >= self.height:
+            return None
+
+        self.set_index(x_y[0] * self.height + x_y[1], color)
+
+    def fill(self, color) -> None:
+        for pixel_idx in range(self.width * self.height):
+            self.set_index(pixel_idx, color)
+
+    def rect(self, rect, color) -> None:
+        for x in range(max(rect[0], 0), min(rect[0] + rect[2], self.width)):
+            for y in range(max(rect[1], 0), min(rect[1] + rect[3], self.height)):
+                self.set_index(x * self.height + y, color)
+
+    def send_pixel(self, pixel_idx: int) -> None:
+        offset = pixel_idx * 3
+        color = self.pixels[offset:offset + 3]
+
+        self.emitter.build(*self.to_world(*divmod(pixel_idx, self.height)), tuple(color))
+        self.world[offset:offset + 3] = color
+        self.built[pixel_idx] = 1
+
+    def get_center(self) -> tuple[float, float, float]:
+        return self.to_world(self.width / 2, self.height / 2)
+
+    def get_viewers(self, distance: float) -> set:
+        return set(get_player_grid(self.emitter.protocol).players_near(self.get_center(), distance))
+
+    def update_viewers(self) -> None:
+        if self.view_distance <= 0:
+            return None
+
+        viewers = self.get_viewers(self.view_distance * DISPLAY_VIEW_EXIT_MARGIN)
+
+        # Only players within view_distance come in, the others in the margin stay out until then
+        entering = viewers - self.emitter.viewers
+        if entering:
+            entering &= self.get_viewers(self.view_distance)
+
+        # Players coming in range missed the updates sent while they were away
+        for player in entering:
+            self.send_snapshot(player, stale=player in self.former_viewers)
+
+        self.emitter.viewers = (viewers & self.emitter.viewers) | entering
+        self.former_viewers.update(entering)
+
+    def refresh(self, threshold: int = 0, packet_budget: int = 0, skip=None) -> None:
+        # threshold: summed r, g, b difference a pixel needs before it is rebuilt, 0 rebuilds any change
+        # packet_budget: if set, largest differences are sent first and the rest stays dirty for the next refresh
+        # skip: pixel_idx -> bool, skipped pixels stay dirty for the next refresh
+        self.update_viewers()
+
+        # Under heavy lag, decorative displays nobody is close to wait with their changes until someone comes closer or the lag drops.
+        # Games keep refreshing, their players may stand further than FAR_DISPLAY_DISTANCE from the screen center
+        if watchdog.level >= FAR_DISPLAYS_LEVEL and self.emitter.priority >= PRIORITY_DECORATION and not get_player_grid(self.emitter.protocol).any_player_near(self.get_center(), FAR_DISPLAY_DISTANCE):
+            return None
+
+        pixels = self.pixels
+        world = self.world
+        still_dirty = set()
+        changed = []
+
+        for pixel_idx in self.dirty:
+            if skip is not None and skip(pixel_idx):
+                still_dirty.add(pixel_idx)
+                continue
+
+            offset = pixel_idx * 3
+            color_diff = abs(pixels[offset] - world[offset])
+            color_diff += abs(pixels[offset + 1] - world[offset + 1])
+            color_diff += abs(pixels[offset + 2] - world[offset + 2])
+
+            if color_diff > threshold:
+                changed.append((color_diff, pixel_idx))
+
+        if packet_budget > 0:
+            changed.sort(reverse=True)
+
+            # Each block is one packet, plus one SetColor the first time its color is used
+            packets = 0
+            colors = set()
+
+            for _, pixel_idx in changed:
+                color = bytes(pixels[pixel_idx * 3:pixel_idx * 3 + 3])
+                cost = 1 if color in colors else 2
+
+                if packets + cost > packet_budget:
+                    still_dirty.add(pixel_idx)
+                    continue
+
+                packets += cost
+                colors.add(color)
+                self.send_pixel(pixel_idx)
+        else:
+            for _, pixel_idx in changed:
+                self.send_pixel(pixel_idx)
+
+        self.dirty = still_dirty
+        self.emitter.flush()
+
+    def full_refresh(self) -> None:
+        # Rebuild every pixel, whatever players are supposed to see
+        self.update_viewers()
+
+        for pixel_idx in range(self.width * self.height):
+            self.send_pixel(pixel_idx)
+
+        self.dirty.clear()
+        self.emitter.flush()
+
+    def send_snapshot(self, connection, stale: bool = False) -> None:
+        # Build what the world shows for a single player. Without `stale` the player has none of the display blocks
+        # (the map they downloaded doesn't have them), with it they still have old ones, which block lines can't recolor
+        emitter = BlockEmitter(self.emitter.protocol, self.emitter.player_id, connection=connection)
+        emitter.perf = self.emitter.perf
+        world = self.world
+
+        for pixel_idx in range(self.width * self.height):
+            if not self.built[pixel_idx]:
+                continue
+
+            offset = pixel_idx * 3
+            pos = self.to_world(*divmod(pixel_idx, self.height))
+            emitter.build(*pos, tuple(world[offset:offset + 3]))
+
+            if stale:
+                emitter.display_blocks.add(pos)
+
+        emitter.flush()
+
+    def clear(self) -> None:
+        # Remove the display blocks for every player, the ones out of range may still have old ones
+        self.emitter.viewers = None
+
+        for x in range(self.width):
+            for y in range(self.height):
+                self.emitter.destroy(*self.to_world(x, y))
+
+        self.emitter.flush()
+        self.close()
+
+    def close(self) -> None:
+        # The display blocks were removed from the world, players joining from now on don't need them
+        framebuffers = open_framebuffers.get(self.emitter.protocol)
+        if framebuffers is not None:
+            framebuffers.discard(self)
+
+
+def send_display_snapshots(connection) -> None:
+    # Every display script calls this from on_join, the snapshots are only sent by the first one
+    if connection in synced_connections:
+        return None
+
+    synced_connections.add(connection)
+
+    for framebuffer in list(open_framebuffers.get(connection.protocol, ())):
+        # Those catch up the player when they come in range
+        if framebuffer.view_distance > 0:
+            continue
+
+        framebuffer.send_snapshot(connection)
@@ -1,11 +1,24 @@
 from piqueserver.commands import command
-from pyspades.contained import BlockAction, SetColor
-from pyspades.common import make_color
-from twisted.internet.task import LoopingCall
-from pyspades.constants import BUILD_BLOCK, DESTROY_BLOCK
-from math import sqrt
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThread
 from PIL import Image
+import numpy as np
+import hashlib
 import os
+import sys
+import tempfile
+
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+if SCRIPTS_DIRECTORY not in sys.path:
+    sys.path.append(SCRIPTS_DIRECTORY)
+
+from block_emitter import BlockEmitter
+from framebuffer import FrameBuffer, send_display_snapshots
+from display_scheduler import ScheduledCall
+from player_grid import get_player_grid
+from perf_stats import get_display_stats, remove_display_stats
+from lag_watchdog import watchdog, GIF_SLOWDOWN_LEVEL, GIF_THRESHOLD_LEVEL, GIF_THRESHOLD_FACTOR
 
 # Gif player by Gato
 # To play a gif make a gifs directory in the parent directory of scripts
@@ -16,6 +29,15 @@ GIF_SIZE_REDUCTION = 20
 DEFAULT_PLAYBACK_SPEED = 0.1  # Render the next frame every 0.1 secs. Can be changed to any value
 DEFAULT_AXIS = "x"
 DEACTIVATION_RADIUS = 15  # Gifs won't update if there is no player closer than 15 blocks
+PIXEL_UPDATE_THRESHOLD = 50  # A block is only rebuilt when its average color difference is above this
+LOADING_PROGRESS_STEP = 25  # Report loading progress in chat every 25%
+BASE_DIRECTORY = os.path.dirname(SCRIPTS_DIRECTORY)
+GIF_CACHE_DIRECTORY = os.path.join(BASE_DIRECTORY, "gifs", "cache")  # Decoded and downscaled frames are kept here so the same gif loads instantly next time
+DEFAULT_PACKET_BUDGET = 0  # Max packets a gif sends per frame, largest color errors first. 0 uses the checkerboard instead
+STREAMING_FRAME_BUDGET = 600  # Gifs with more frames than this are streamed instead of fully decoded in memory
+STREAMING_BYTE_BUDGET = 32 * 1024 * 1024  # Same for gifs whose decoded (downscaled) frames would take more bytes than this
+STREAMING_BUFFER_FRAMES = 48  # Decoded frames kept in memory by a streamed gif
+STREAMING_READ_AHEAD = 24  # How many frames ahead of the playhead a streamed gif decodes
 
 @command("gif")
 def gif(connection, file_name: str = "pedro.gif", gif_tag: str = "gif0", playback_speed: str = str(DEFAULT_PLAYBACK_SPEED), scale: str = str(GIF_SIZE_REDUCTION), axis: str = DEFAULT_AXIS) -> None:
@@ -29,102 +51,425 @@ def delete_gif(connection, gif_tag: str = "gif0") -> None:
 def pause_gif(connection, gif_tag: str):
     connection.pause_gif(gif_tag)
 
-class Gif:
-    def __init__(self, file_path: str, connection, playback_speed: float = DEFAULT_PLAYBACK_SPEED, scale: int = GIF_SIZE_REDUCTION, axis: str = DEFAULT_AXIS) -> None:
+@command("gif_budget")
+def gif_budget(connection, gif_tag: str, packet_budget: str = str(DEFAULT_PACKET_BUDGET)):
+    connection.set_gif_budget(gif_tag, int(packet_budget))
+
+def compute_frame_delta(previous: np.ndarray, current: np.ndarray) -> np.ndarray:
+    # Screen pixel indices (x * height + y) whose color changed between two frames, however little.
+    # The update threshold is applied by the framebuffer against what players see, so slow fades still add up
+    changed = (current != previous).any(axis=2)
+
+    # Frames are stored top to bottom while screen rows go bottom to top
+    return np.flatnonzero(changed[:, ::-1]).astype(np.int32)
+
+def sample_frame(gif, width: int, height: int, scale: int) -> np.ndarray:
+    # Current frame of an open gif as [x][y] -> (r, g, b), sampled every `scale` pixels from the top left corner
+    pixels = np.asarray(gif.convert("RGB"))  # (full_height, full_width, 3)
+
+    return np.ascontiguousarray(pixels[:height * scale:scale, :width * scale:scale].transpose(1, 0, 2))
+
+def is_over_streaming_budget(shape: tuple[int, int, int, int]) -> bool:
+    tot_frames, width, height = shape[:3]
+
+    # Short gifs are always kept in memory, the stream buffer would hold most of them anyway
+    if tot_frames <= STREAMING_BUFFER_FRAMES:
+        return False
+
+    return tot_frames > STREAMING_FRAME_BUDGET or tot_frames * width * height * 3 > STREAMING_BYTE_BUDGET
+
+class GifFrames:
+    # Decoded frames of one gif file at one scale, shared (read only) by every Gif playing it
+    def __init__(self, file_path: str, scale: int) -> None:
         self.file_path = file_path
+        self.scale = scale
+        self.width = 0
+        self.height = 0
+
+        self.frames = None
+        self.deltas = None
+        self.streamed = False  # Too long to keep in memory, every Gif playing it decodes its own FrameStream
+        self.tot_frames = 0
+        self.frames_loaded = 0
+
+        self.users = 0
+        self.listeners = []
+        self.cancelled = False
+        self.failure = None
+
+        # Decoding happens off the reactor thread, playback starts as soon as the first frame is ready
+        self.loading = deferToThread(self.load_gif_data)
+        self.loading.addErrback(self.on_load_failed)
+
+    def add_listener(self, listener) -> None:
+        self.listeners.append(listener)
+
+        # Late listeners catch up with what is already loaded
+        if self.failure is not None:
+            listener.on_load_failed(self.failure)
+            return None
+
+        if self.tot_frames > 0:
+            listener.on_gif_opened()
+
+        if self.frames_loaded > 0:
+            listener.on_frames_loaded()
+
+    def remove_listener(self, listener) -> None:
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def load_gif_data(self) -> None:
+        # Runs in a worker thread: everything touching the game goes through reactor.callFromThread
+        cache_path = self.get_cache_path()
+        frames = self.load_cached_frames(cache_path)
+
+        if frames is not None:
+            # Mapped frames are paged in on demand, long gifs only skip the precomputed deltas
+            deltas = None
+            if not is_over_streaming_budget(frames.shape):
+                deltas = [compute_frame_delta(frames[idx - 1], frames[idx]) for idx in range(len(frames))]
+
+            reactor.callFromThread(self.on_gif_opened, frames.shape, frames, deltas)
+            reactor.callFromThread(self.on_frames_loaded, len(frames))
+            return None
+
+        gif = Image.open(self.file_path)
+        full_width, full_height = gif.size
+        shape = (getattr(gif, "n_frames", 1), int(full_width / self.scale), int(full_height / self.scale), 3)
+
+        if is_over_streaming_budget(shape):
+            gif.close()
+            reactor.callFromThread(self.on_stream_opened, shape)
+            return None
+
+        frames = self.decode_gif_frames(gif, shape)
+        gif.close()
+
+        if frames is not None:
+            frames.flags.writeable = False
+            self.save_cached_frames(cache_path, frames)
+
+    def on_gif_opened(self, shape: tuple[int, int, int, int], frames: np.ndarray, deltas: list) -> None:
+        self.frames = frames
+        self.deltas = deltas
+        self.tot_frames, self.width, self.height = shape[:3]
+
+        for listener in self.listeners:
+            listener.on_gif_opened()
+
+    def on_stream_opened(self, shape: tuple[int, int, int, int]) -> None:
+        self.streamed = True
+
+        # Every frame can be reached, the streams decode them when their playhead gets close
+        self.on_gif_opened(shape, None, None)
+        self.on_frames_loaded(shape[0])
+
+    def on_frames_loaded(self, frames_loaded: int) -> None:
+        self.frames_loaded = frames_loaded
+
+        for listener in self.listeners:
+            listener.on_frames_loaded()
+
+    def on_load_failed(self, failure) -> None:
+        self.failure = failure
+
+        for listener in list(self.listeners):
+            listener.on_load_failed(failure)
+
+    def open_stream(self):
+        # Each playhead needs its own sequential decoder, only the file and its shape are shared
+        return FrameStream(self, (self.tot_frames, self.width, self.height, 3))
+
+    def get_frame(self, frame_idx: int):
+        # (frame, delta from the previous frame or None) or None when the frame isn't decoded yet
+        if frame_idx >= self.frames_loaded:
+            return None
+
+        if self.deltas is None:
+            return self.frames[frame_idx], compute_frame_delta(self.frames[frame_idx - 1], self.frames[frame_idx])
+
+        return self.frames[frame_idx], self.deltas[frame_idx]
+
+    def close(self) -> None:
+        self.cancelled = True
+
+    def decode_gif_frames(self, gif, shape: tuple[int, int, int, int]) -> np.ndarray:
+        tot_frames, width, height = shape[:3]
+
+        # frames[frame][x][y] -> (r, g, b)
+        frames = np.empty(shape, dtype=np.uint8)
+        # deltas[frame] -> screen pixels that changed since the previous frame, None until it can be computed
+        deltas = [None] * tot_frames
+        reactor.callFromThread(self.on_gif_opened, shape, frames, deltas)
+
+        for current_frame_idx in range(tot_frames):
+            if self.cancelled:
+                return None
+
+            gif.seek(current_frame_idx)
+            frames[current_frame_idx] = sample_frame(gif, width, height, self.scale)
+
+            if current_frame_idx > 0:
+                deltas[current_frame_idx] = compute_frame_delta(frames[current_frame_idx - 1], frames[current_frame_idx])
+
+            reactor.callFromThread(self.on_frames_loaded, current_frame_idx + 1)
+
+        # The first frame is diffed against the last one, for when playback loops
+        deltas[0] = compute_frame_delta(frames[-1], frames[0])
+        return frames
+
+    def get_cache_path(self) -> str:
+        # Keyed by content so a replaced file with the same name is decoded again
+        digest = hashlib.sha1()
+        with open(self.file_path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 16), b""):
+                digest.update(chunk)
+
+        return os.path.join(GIF_CACHE_DIRECTORY, f"{digest.hexdigest()}_{self.scale}.npy")
+
+    def load_cached_frames(self, cache_path: str):
+        if not os.path.isfile(cache_path):
+            return None
+
+        try:
+            frames = np.load(cache_path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+
+        if frames.ndim != 4 or frames.dtype != np.uint8:
+            return None
+
+        return frames
+
+    def save_cached_frames(self, cache_path: str, frames: np.ndarray) -> None:
+        tmp_path = None
+        try:
+            os.makedirs(GIF_CACHE_DIRECTORY, exist_ok=True)
+
+            # Unique name, gifs with the same content can be saved by two threads at once
+            tmp_fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=GIF_CACHE_DIRECTORY)
+            with os.fdopen(tmp_fd, "wb") as file:
+                np.save(file, frames)
+
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # The cache is only an optimization, the gif still plays without it
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class FrameStream:
+    # Long gifs are decoded a few frames ahead of the playhead into a bounded buffer instead of all at once
+    # Gif decoding is sequential: a playhead that falls behind the buffer makes the stream start over from frame 0
+    def __init__(self, gif_frames: GifFrames, shape: tuple[int, int, int, int]) -> None:
+        self.gif_frames = gif_frames
+        self.gif = None  # Opened by the first decode, in the worker thread
+        self.shape = shape
+        self.tot_frames, self.width, self.height = shape[:3]
+
+        # frame index -> (frame, delta), oldest decoded first
+        self.buffer: dict[int, tuple] = {}
+        self.next_frame_idx = 0
+        self.previous_frame = None
+
+        self.decoding = False
+        self.cancelled = False
+        self.closed = False
+
+    def get_frame(self, frame_idx: int):
+        entry = self.buffer.get(frame_idx)
+
+        if not self.decoding and not self.closed and self.frames_ready(frame_idx) <= STREAMING_READ_AHEAD // 2:
+            self.decoding = True
+            deferToThread(self.decode_ahead, frame_idx).addBoth(self.on_decoded)
+
+        return entry
+
+    def frames_ready(self, frame_idx: int) -> int:
+        ready = 0
+        while ready < STREAMING_READ_AHEAD and (frame_idx + ready) % self.tot_frames in self.buffer:
+            ready += 1
+
+        return ready
+
+    def on_decoded(self, result):
+        self.decoding = False
+        if self.cancelled:
+            self.close()
+
+        return result
+
+    def decode_ahead(self, frame_idx: int) -> None:
+        # Runs in a worker thread, one batch at a time
+        if self.gif is None:
+            self.gif = Image.open(self.gif_frames.file_path)
+
+        if frame_idx not in self.buffer and frame_idx < self.next_frame_idx:
+            self.next_frame_idx = 0
+            self.previous_frame = None
+
+        while (self.next_frame_idx - frame_idx) % self.tot_frames < STREAMING_READ_AHEAD or frame_idx not in self.buffer:
+            if self.cancelled:
+                return None
+
+            self.decode_next_frame()
+
+    def decode_next_frame(self) -> None:
+        current_frame_idx = self.next_frame_idx
+        self.gif.seek(current_frame_idx)
+        frame = sample_frame(self.gif, self.width, self.height, self.gif_frames.scale)
+
+        # The previous frame is unknown after starting over, the player checks every pixel then
+        delta = None
+        if self.previous_frame is not None:
+            delta = compute_frame_delta(self.previous_frame, frame)
+
+        self.buffer.pop(current_frame_idx, None)
+        self.buffer[current_frame_idx] = (frame, delta)
+        while len(self.buffer) > STREAMING_BUFFER_FRAMES:
+            del self.buffer[next(iter(self.buffer))]
+
+        self.previous_frame = frame
+        self.next_frame_idx = (current_frame_idx + 1) % self.tot_frames
+
+    def close(self) -> None:
+        # A decode in progress stops at the next frame and closes the stream once done
+        self.cancelled = True
+        if self.closed or self.decoding:
+            return None
+
+        self.closed = True
+        self.buffer.clear()
+        if self.gif is not None:
+            self.gif.close()
+
+
+class FrameStore:
+    # Reference counted GifFrames keyed by (file, scale): placing the same gif many times decodes and stores it once
+    def __init__(self) -> None:
+        self.entries: dict[tuple[str, int], GifFrames] = {}
+
+    def acquire(self, file_path: str, scale: int) -> GifFrames:
+        key = (file_path, scale)
+        gif_frames = self.entries.get(key)
+
+        if gif_frames is None or gif_frames.failure is not None:
+            gif_frames = GifFrames(file_path, scale)
+            self.entries[key] = gif_frames
+
+        gif_frames.users += 1
+        return gif_frames
+
+    def release(self, gif_frames: GifFrames) -> None:
+        gif_frames.users -= 1
+        if gif_frames.users > 0:
+            return None
+
+        # Last user gone: stop decoding and let the frames be freed
+        gif_frames.close()
+        key = (gif_frames.file_path, gif_frames.scale)
+        if self.entries.get(key) is gif_frames:
+            del self.entries[key]
+
+
+frame_store = FrameStore()
+
+
+class Gif:
+    def __init__(self, file_path: str, connection, playback_speed: float = DEFAULT_PLAYBACK_SPEED, scale: int = GIF_SIZE_REDUCTION, axis: str = DEFAULT_AXIS, name: str = "gif") -> None:
+        self.file_path = os.path.join(BASE_DIRECTORY, file_path)
         self.width = 0
         self.height = 0
         self.connection = connection
+        self.playback_speed = playback_speed
         self.scale = scale
         self.axis = axis
         self.paused = False
+        self.killed = False
+        self.packet_budget = DEFAULT_PACKET_BUDGET
 
-        self.frames = []
         self.tot_frames = 0
+        self.frames_loaded = 0
+        self.reported_progress = 0
         self.ticks = 0
+        self.updates = 0
 
         self.x, self.y, self.z = self.connection.get_location()
-        self.load_gif_data()
+        self.screen = None
+        self.emitter = BlockEmitter(self.connection.protocol)
+        self.last_frame_idx = None
+        self.stream = None
 
-        self.center_x, self.center_y, self.center_z = self.get_center()
+        self.perf = get_display_stats(name)
+        self.emitter.perf = self.perf
 
-        self.screen_buffer = [[(255, 0, 0) for y in range(self.height)] for x in range(self.width)]
+        self.loop = ScheduledCall(self.perf.measure(self.update, playback_speed))
 
-        self.loop = LoopingCall(self.update)
-        self.loop.start(playback_speed)
+        # Fires once every frame is loaded, or with the error if loading failed
+        self.loading = Deferred()
 
-    def load_gif_data(self) -> None:
-        base_path = os.path.dirname(os.path.abspath(__file__))
-        os.chdir(base_path)
-        os.chdir("..")
+        self.gif_frames = frame_store.acquire(self.file_path, self.scale)
+        self.gif_frames.add_listener(self)
 
-        gif = Image.open(self.file_path)
-        current_frame_idx = 0
+    def on_gif_opened(self) -> None:
+        self.tot_frames = self.gif_frames.tot_frames
+        self.width = self.gif_frames.width
+        self.height = self.gif_frames.height
 
-        while True:
-            try:
-                gif.seek(current_frame_idx)
-                frame = gif.convert("RGB")
+        self.center_x, self.center_y, self.center_z = self.get_center()
 
-                pixels = frame.load()
+        self.screen = FrameBuffer(self.width, self.height, self.screen_to_world, self.emitter, color=(255, 0, 0))
 
-                self.width, self.height = frame.size
+        if self.gif_frames.streamed:
+            self.stream = self.gif_frames.open_stream()
 
-                current_frame = [[(0, 0, 0) for y in range(self.height)] for x in range(self.width)]
+        self.connection.send_chat(f"Loading gif: {self.tot_frames} frames")
 
-                for x in range(0, self.width, self.scale):
-                    for y in range(0, self.height, self.scale):
-                        pixel = pixels[x, y]
+    def on_frames_loaded(self) -> None:
+        if self.killed:
+            return None
 
-                        current_frame[int(x / self.scale)][int(y / self.scale)] = (pixel[0], pixel[1], pixel[2])
-                
-                self.frames.append(current_frame)
+        self.frames_loaded = self.gif_frames.frames_loaded
 
-                current_frame_idx += 1
+        if not self.loop.running:
+            self.loop.start(self.playback_speed)
 
-            except EOFError:
-                self.width = int(self.width / self.scale)
-                self.height = int(self.height / self.scale)
+        if self.frames_loaded == self.tot_frames:
+            if not self.loading.called:
+                streaming = " streamed" if self.stream is not None else ""
+                self.connection.send_chat(f"Loaded gif ! ({self.tot_frames}{streaming} frames)")
+                self.loading.callback(None)
+            return None
 
-                self.tot_frames = current_frame_idx
-                self.connection.send_chat(f"Tot frames: {self.tot_frames}")
-                break
-        
-        gif.close()
-    
-    def get_dist(self, x, y, z) -> float:
-        return sqrt(
-            (x - self.center_x)**2 +
-            (y - self.center_y)**2 +
-            (z - self.center_z)**2
-        )
-    
-    def check_for_nearby_players(self) -> None:
-        self.paused = True
-        for player in self.connection.protocol.players.values():
-            if not player.world_object: return None
+        progress = (100 * self.frames_loaded // self.tot_frames) // LOADING_PROGRESS_STEP * LOADING_PROGRESS_STEP
+        if progress > self.reported_progress:
+            self.reported_progress = progress
+            self.connection.send_chat(f"Loading gif: {progress}% ({self.frames_loaded}/{self.tot_frames} frames)")
 
-            dist = self.get_dist(*player.world_object.position.get())
+    def on_load_failed(self, failure) -> None:
+        if not self.loading.called:
+            self.loading.errback(failure)
 
-            if dist < DEACTIVATION_RADIUS:
-                self.paused = False
-                return None
+    def check_for_nearby_players(self) -> None:
+        grid = get_player_grid(self.connection.protocol)
+        self.paused = not grid.any_player_near((self.center_x, self.center_y, self.center_z), DEACTIVATION_RADIUS)
 
     def update(self) -> None:
+        self.updates += 1
+
+        # Under lag gifs play at half speed, every frame is still shown so the deltas can be used
+        if watchdog.skip_frame(GIF_SLOWDOWN_LEVEL, self.updates):
+            return None
+
         self.ticks += 1
         self.check_for_nearby_players()
 
         if not self.paused:
             self.render_frame()
-    
-    def pixel_needs_to_update(self, pixel_x: int, pixel_y: int, target_color: tuple[int, int, int]) -> None:
-        pixel = self.screen_buffer[pixel_x][pixel_y]
-        color_diff = abs(pixel[0] - target_color[0])
-        color_diff += abs(pixel[1] - target_color[1])
-        color_diff += abs(pixel[2] - target_color[2])
-        color_diff /= 3
-
-        return color_diff > 50
+        elif self.screen is not None:
+            # Players further away than the deactivation radius still get the last frame when they come closer
+            self.screen.update_viewers()
     
     def screen_to_world(self, screen_x: int, screen_y: int) -> tuple[int, int, int]:
         if self.axis == "x":
@@ -170,38 +515,83 @@ class Gif:
         
         return center_pos
     
-    def change_pixel(self, screen_x: int, screen_y: int, pixel_color: tuple[int, int, int]) -> None:
-        pixel_x, pixel_y, pixel_z = self.screen_to_world(screen_x, screen_y)
-
-        if self.pixel_needs_to_update(screen_x, screen_y, pixel_color):
-            self.connection.set_block(pixel_x, pixel_y, pixel_z, pixel_color)
-            self.screen_buffer[screen_x][screen_y] = pixel_color
-    
     def render_frame(self) -> None:
-        frame = self.frames[self.ticks % self.tot_frames]
+        frame_idx = self.ticks % self.frames_loaded
+        if self.stream is not None:
+            entry = self.stream.get_frame(frame_idx)
+        else:
+            entry = self.gif_frames.get_frame(frame_idx)
+
+        if entry is None:
+            # Streamed frame not decoded yet, keep showing the current one
+            return None
 
-        for x in range(self.width):
-            for y in range(self.height):
-                if (x + y)%2 == self.ticks % 2:
-                    continue
+        frame, delta = entry
 
-                self.change_pixel(x, y, frame[x][self.height - y - 1])
+        if delta is None or self.last_frame_idx is None or frame_idx != (self.last_frame_idx + 1) % self.frames_loaded:
+            # Nothing to diff against (first render, frames skipped while paused, frame still loading): write everything
+            candidates = range(self.width * self.height)
+        else:
+            candidates = delta.tolist()
+
+        self.last_frame_idx = frame_idx
+
+        # Flat view of the frame's bytes (3 per pixel), no copy
+        frame = memoryview(frame.reshape(-1))
+        height = self.height
+
+        for pixel_idx in candidates:
+            x, y = divmod(pixel_idx, height)
+
+            # Frames are stored top to bottom while screen rows go bottom to top
+            frame_offset = (x * height + height - y - 1) * 3
+            self.screen.set_index(pixel_idx, frame[frame_offset:frame_offset + 3])
+
+        threshold = PIXEL_UPDATE_THRESHOLD * 3
+        if watchdog.level >= GIF_THRESHOLD_LEVEL:
+            threshold *= GIF_THRESHOLD_FACTOR
+
+        if self.packet_budget > 0:
+            self.screen.refresh(threshold, self.packet_budget)
+            return None
+
+        # Checkerboard: half of the pixels each tick, the other half stays dirty until the next one
+        parity = self.ticks % 2
+        self.screen.refresh(threshold, skip=lambda pixel_idx: sum(divmod(pixel_idx, height)) % 2 == parity)
 
     def clear_pixels(self) -> None:
-        for x in range(self.width):
-            for y in range(self.height):
-                pixel_pos = self.screen_to_world(x, y)
-                self.connection.del_block(*pixel_pos)
+        # No screen yet means nothing was built
+        if self.screen is None:
+            return None
+
+        self.screen.clear()
 
     def kill(self) -> None:
+        if self.killed:
+            return None
+
+        self.killed = True
         self.clear_pixels()
-        self.loop.stop()
+
+        if self.stream is not None:
+            self.stream.close()
+
+        self.gif_frames.remove_listener(self)
+        frame_store.release(self.gif_frames)
+        remove_display_stats(self.perf.name)
+
+        if self.loop.running:
+            self.loop.stop()
 
 
 def apply_script(protocol, connection, config):
     class GifConnection(connection):
         all_gifs: dict[str, Gif] = {}
     
+        def on_join(self) -> None:
+            send_display_snapshots(self)
+            return connection.on_join(self)
+
         def load_gif(self, file_name: str, gif_tag: str, playback_speed: float, scale: int, axis: str) -> None:
             if self.all_gifs.get(gif_tag) != None:
                 self.send_chat("This gif already exists. Delete it with /dgif to create a new one with the same gif tag")
@@ -211,8 +601,17 @@ def apply_script(protocol, connection, config):
                 self.send_chat("Invalid axis for gif. Must be 'x', 'y' or 'z'")
                 return None
 
-            self.all_gifs[gif_tag] = Gif(file_name, self, playback_speed, scale, axis)
-            self.send_chat("Loaded gif !")
+            _gif = Gif(file_name, self, playback_speed, scale, axis, f"gif-{gif_tag}")
+            _gif.loading.addErrback(self.on_gif_load_failed, gif_tag, _gif)
+
+            self.all_gifs[gif_tag] = _gif
+        
+        def on_gif_load_failed(self, failure, gif_tag: str, _gif: Gif) -> None:
+            _gif.kill()
+            if self.all_gifs.get(gif_tag) is _gif:
+                del self.all_gifs[gif_tag]
+
+            self.send_chat(f"Could not load gif '{gif_tag}': {failure.getErrorMessage()}")
         
         def remove_gif(self, gif_tag: str) -> None:
             if self.all_gifs.get(gif_tag) == None:
@@ -234,31 +633,18 @@ def apply_script(protocol, connection, config):
             
             _gif.paused = not _gif.paused
         
-        def set_block(self, block_x: int, block_y: int, block_z: int, color: tuple[int, int, int]) -> None:
-            set_color = SetColor()
-            set_color.value = make_color(*color)
-            set_color.player_id = 32
-
-            self.protocol.broadcast_contained(set_color)
-
+        def set_gif_budget(self, gif_tag: str, packet_budget: int) -> None:
+            _gif = self.all_gifs.get(gif_tag)
 
-            block_action = BlockAction()
-            block_action.x = block_x
-            block_action.y = block_y
-            block_action.z = block_z
-            block_action.value = BUILD_BLOCK
-            block_action.player_id = 32
+            if _gif == None:
+                self.send_chat(f"No gif found with the following tag: {gif_tag}")
+                return None
+            
+            _gif.packet_budget = max(0, packet_budget)
 
-            self.protocol.broadcast_contained(block_action)
-        
-        def del_block(self, block_x: int, block_y: int, block_z: int) -> None:
-            block_action = BlockAction()
-            block_action.x = block_x
-            block_action.y = block_y
-            block_action.z = block_z
-            block_action.value = DESTROY_BLOCK
-            block_action.player_id = 32
-
-            self.protocol.broadcast_contained(block_action)
+            if _gif.packet_budget > 0:
+                self.send_chat(f"Gif '{gif_tag}' now sends at most {_gif.packet_budget} packets per frame")
+            else:
+                self.send_chat(f"Gif '{gif_tag}' packet budget disabled")
 
     return protocol, GifConnection
\ No newline at end of file
@@ -0,0 +1,92 @@
+import time
+
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
+
+# Reactor lag watchdog for the display scripts (gif player, car game, tetris)
+# The displays get cheaper level by level while the reactor is late, decorative ones (gifs) first and games last.
+# Levels go up as soon as the lag is over their threshold and down once it stayed low for a while
+
+WATCHDOG_INTERVAL = 0.1  # Lag is measured every 0.1 secs
+LAG_SMOOTHING = 0.3  # Weight of the newest measure in the smoothed lag, lower ignores more spikes
+LAG_LEVELS = (0.01, 0.025, 0.05, 0.1)  # Smoothed lag (secs) entering degradation level 1, 2, 3 and 4
+LAG_RECOVERY_RATIO = 0.5  # A level is left once the lag is under half of its threshold ...
+LAG_RECOVERY_TIME = 5.0  # ... for 5 secs in a row
+
+GIF_SLOWDOWN_LEVEL = 1  # Gifs play at half speed
+GIF_THRESHOLD_LEVEL = 2  # Gifs need GIF_THRESHOLD_FACTOR times the color difference before a block is rebuilt
+FAR_DISPLAYS_LEVEL = 3  # Decorative displays (gifs) without a player within FAR_DISPLAY_DISTANCE stop refreshing, games never do
+GAME_FPS_LEVEL = 4  # Tetris moves are only shown with the next gravity step and the car game refreshes its screen every other frame, the games themselves run at full speed
+
+GIF_THRESHOLD_FACTOR = 2
+FAR_DISPLAY_DISTANCE = 32
+
+log = Logger()
+
+
+class LagWatchdog:
+    def __init__(self, interval: float = WATCHDOG_INTERVAL) -> None:
+        self.interval = interval
+        self.lag = 0.0
+        self.level = 0
+
+        self.last_check = None
+        self.recovery_start = None
+
+        self.loop = LoopingCall(self.check)
+
+    def start(self) -> None:
+        if self.loop.running:
+            return None
+
+        self.last_check = time.perf_counter()
+        self.loop.start(self.interval, now=False)
+
+    def stop(self) -> None:
+        if not self.loop.running:
+            return None
+
+        self.loop.stop()
+        self.lag = 0.0
+        self.set_level(0)
+
+    def check(self) -> None:
+        now = time.perf_counter()
+        lag = max(0.0, now - self.last_check - self.interval)
+        self.last_check = now
+
+        self.lag = self.lag * (1 - LAG_SMOOTHING) + lag * LAG_SMOOTHING
+
+        level = self.level
+        while level < len(LAG_LEVELS) and self.lag > LAG_LEVELS[level]:
+            level += 1
+
+        if level > self.level:
+            self.recovery_start = None
+            self.set_level(level)
+            return None
+
+        if self.level == 0 or self.lag >= LAG_LEVELS[self.level - 1] * LAG_RECOVERY_RATIO:
+            self.recovery_start = None
+            return None
+
+        if self.recovery_start is None:
+            self.recovery_start = now
+        elif now - self.recovery_start >= LAG_RECOVERY_TIME:
+            # One level at a time, the next one needs its own quiet period
+            self.recovery_start = None
+            self.set_level(self.level - 1)
+
+    def set_level(self, level: int) -> None:
+        if level == self.level:
+            return None
+
+        log.info("Reactor lag {lag:.1f}ms, display degradation level {old} -> {new}", lag=self.lag * 1000, old=self.level, new=level)
+        self.level = level
+
+    def skip_frame(self, level: int, frame: int) -> bool:
+        # Frames to skip once `level` is reached, every other one
+        return self.level >= level and frame % 2 == 1
+
+
+watchdog = LagWatchdog()
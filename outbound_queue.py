@@ -0,0 +1,98 @@
+from weakref import WeakKeyDictionary
+
+from twisted.internet.task import LoopingCall
+
+# Shared outbound queue for the scripts broadcasting a lot (gif player, car game, tetris, roles)
+# Flushed blocks and chat messages are queued per protocol and sent at most OUTBOUND_PACKET_BUDGET packets per tick,
+# most important first. A block still waiting when it changes again is only sent once, with its latest state
+
+OUTBOUND_RATE = 60  # Ticks per second
+OUTBOUND_PACKET_BUDGET = 100  # Packets broadcast per tick, a block action is 15 bytes for every player receiving it
+
+PRIORITY_CHAT = 0
+PRIORITY_GAME = 1  # Tetris, car game
+PRIORITY_DECORATION = 2  # Gifs
+
+
+class OutboundQueue:
+    def __init__(self, protocol, budget: int = OUTBOUND_PACKET_BUDGET) -> None:
+        self.protocol = protocol
+        self.budget = budget
+
+        # pos -> (emitter, color or None to destroy it), the latest write wins but keeps its place in the queue
+        self.blocks: dict[tuple[int, int, int], tuple] = {}
+        self.chats: list[str] = []
+
+        self.loop = LoopingCall(self.tick)
+
+    def push_blocks(self, emitter) -> None:
+        for pos in emitter.destroys:
+            self.blocks[pos] = (emitter, None)
+
+        for pos, color in emitter.builds.items():
+            self.blocks[pos] = (emitter, color)
+
+        emitter.builds.clear()
+        emitter.destroys.clear()
+        self.wake_up()
+
+    def broadcast_chat(self, message: str) -> None:
+        self.chats.append(message)
+        self.wake_up()
+
+    def wake_up(self) -> None:
+        # An idle queue sends right away, a busy one waits for its next tick
+        if not self.loop.running:
+            self.loop.start(1 / OUTBOUND_RATE)
+
+    def tick(self) -> None:
+        if not self.blocks and not self.chats:
+            # Stopping one tick after the queue emptied keeps bursts of pushes to one budget per tick
+            self.loop.stop()
+            return None
+
+        packets = 0
+
+        while self.chats and packets < self.budget:
+            self.protocol.broadcast_chat(self.chats.pop(0))
+            packets += 1
+
+        # Most important emitters first, oldest blocks first among an emitter's priority
+        queued = sorted(self.blocks.items(), key=lambda item: item[1][0].priority)
+        emitters = []
+        colors = set()
+
+        for pos, (emitter, color) in queued:
+            # Each block is one packet, plus one SetColor the first time its emitter uses the color
+            cost = 1
+            if color is not None and (emitter, color) not in colors:
+                cost = 2
+
+            if packets + cost > self.budget:
+                break
+
+            packets += cost
+            del self.blocks[pos]
+
+            if color is None:
+                emitter.destroys.add(pos)
+            else:
+                emitter.builds[pos] = color
+                colors.add((emitter, color))
+
+            if emitter not in emitters:
+                emitters.append(emitter)
+
+        for emitter in emitters:
+            emitter.send_queued()
+
+
+outbound_queues = WeakKeyDictionary()
+
+
+def get_outbound_queue(protocol) -> OutboundQueue:
+    queue = outbound_queues.get(protocol)
+    if queue is None:
+        queue = outbound_queues[protocol] = OutboundQueue(protocol)
+
+    return queue
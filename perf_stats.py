@@ -0,0 +1,168 @@
+import time
+
+from piqueserver.commands import command
+from pyspades.bytes import ByteWriter
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
+
+# Tick timing and packet counters for the display scripts (gif player, car game, tetris, countdown)
+# Importing it registers /perf
+# Every display gets a DisplayStats by name. Its tick callback is wrapped with measure() and its block emitter
+# counts what it sends, packets being counted once per player receiving them
+
+DURATION_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1)  # Upper bounds (secs) of the tick duration histogram, slower ticks go in one last bucket
+PERF_LOG_INTERVAL = 0  # Log the stats of every display every 60 secs for example. 0 disables the log
+
+log = Logger()
+
+
+class DisplayStats:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.reset()
+
+    def reset(self) -> None:
+        self.started = time.perf_counter()
+        self.last_tick = None
+
+        self.ticks = 0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+        self.histogram = [0] * (len(DURATION_BUCKETS) + 1)
+
+        self.late_ticks = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+
+        self.packets = 0
+        self.bytes = 0
+
+    def measure(self, f, interval: float):
+        # Wraps a tick callback running every `interval` secs
+        def measured(*args, **kwargs):
+            start = time.perf_counter()
+
+            # How much later than one interval after the previous tick this one started
+            if self.last_tick is not None:
+                lateness = max(0.0, start - self.last_tick - interval)
+                self.total_lateness += lateness
+                self.max_lateness = max(self.max_lateness, lateness)
+                self.late_ticks += 1
+
+            self.last_tick = start
+
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.record_duration(time.perf_counter() - start)
+
+        return measured
+
+    def record_duration(self, duration: float) -> None:
+        self.ticks += 1
+        self.total_duration += duration
+        self.max_duration = max(self.max_duration, duration)
+
+        for bucket_idx, bucket in enumerate(DURATION_BUCKETS):
+            if duration <= bucket:
+                self.histogram[bucket_idx] += 1
+                return None
+
+        self.histogram[-1] += 1
+
+    def record_packets(self, packets: int, size: int) -> None:
+        self.packets += packets
+        self.bytes += packets * size
+
+    def get_percentile(self, percentile: float) -> str:
+        # Upper bound of the histogram bucket the percentile falls in
+        if self.ticks == 0:
+            return "-"
+
+        count = 0
+        for bucket_idx, bucket_count in enumerate(self.histogram):
+            count += bucket_count
+            if count >= self.ticks * percentile:
+                if bucket_idx == len(DURATION_BUCKETS):
+                    return f">{DURATION_BUCKETS[-1] * 1000:g}ms"
+
+                return f"<{DURATION_BUCKETS[bucket_idx] * 1000:g}ms"
+
+        return "-"
+
+    def get_summary(self) -> str:
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        avg_duration = self.total_duration / self.ticks if self.ticks > 0 else 0.0
+        avg_lateness = self.total_lateness / self.late_ticks if self.late_ticks > 0 else 0.0
+
+        return (
+            f"{self.name}: {self.ticks} ticks, {avg_duration * 1000:.2f}ms avg, {self.get_percentile(0.95)} p95, "
+            f"{self.max_duration * 1000:.2f}ms max, late {avg_lateness * 1000:.1f}ms avg {self.max_lateness * 1000:.1f}ms max, "
+            f"{self.packets / elapsed:.0f} packets/s, {self.bytes / elapsed / 1024:.1f} KB/s"
+        )
+
+    def get_histogram(self) -> str:
+        bounds = [f"<{bucket * 1000:g}ms" for bucket in DURATION_BUCKETS] + [f">{DURATION_BUCKETS[-1] * 1000:g}ms"]
+        return f"{self.name}: " + ", ".join(f"{bound} {count}" for bound, count in zip(bounds, self.histogram))
+
+
+display_stats: dict[str, DisplayStats] = {}
+packet_sizes = {}
+
+log_loop = None
+
+
+def get_display_stats(name: str) -> DisplayStats:
+    global log_loop
+
+    stats = display_stats.get(name)
+    if stats is None:
+        stats = display_stats[name] = DisplayStats(name)
+
+    if PERF_LOG_INTERVAL > 0 and log_loop is None:
+        log_loop = LoopingCall(log_display_stats)
+        log_loop.start(PERF_LOG_INTERVAL, now=False)
+
+    return stats
+
+
+def remove_display_stats(name: str) -> None:
+    display_stats.pop(name, None)
+
+
+def get_packet_size(contained) -> int:
+    # Display packets (block actions, block lines, colors) always have the same size for a given type
+    size = packet_sizes.get(type(contained))
+    if size is None:
+        writer = ByteWriter()
+        contained.write(writer)
+        size = packet_sizes[type(contained)] = len(bytes(writer))
+
+    return size
+
+
+def log_display_stats() -> None:
+    for stats in display_stats.values():
+        log.info(stats.get_summary())
+
+
+@command("perf", admin_only=True)
+def perf(connection, name: str = None):
+    # /perf: every display, /perf <display>: its tick duration histogram, /perf reset: start counting again
+    if name == "reset":
+        for stats in display_stats.values():
+            stats.reset()
+
+        return "Display stats reset"
+
+    if name is not None:
+        stats = display_stats.get(name)
+        if stats is None:
+            return f"No display named {name}. Displays: {', '.join(display_stats) or 'none'}"
+
+        return stats.get_histogram()
+
+    if not display_stats:
+        return "No display running"
+
+    return "\n".join(stats.get_summary() for stats in display_stats.values())
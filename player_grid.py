@@ -0,0 +1,61 @@
+from weakref import WeakKeyDictionary
+
+from display_scheduler import scheduler
+
+# Uniform grid of player positions shared by the display scripts
+# The grid is rebuilt at most once per scheduler tick, then every display only looks at the cells around it
+
+GRID_CELL_SIZE = 16  # Blocks per grid cell, on the x and y axis (maps are only 64 blocks high)
+
+
+class PlayerGrid:
+    def __init__(self, cell_size: int = GRID_CELL_SIZE) -> None:
+        self.cell_size = cell_size
+        self.cells: dict[tuple[int, int], list] = {}
+        self.built_tick = None
+
+    def rebuild(self, players) -> None:
+        self.cells.clear()
+
+        for player in players:
+            # Dead players and players still downloading the map have no world object
+            if not player.world_object:
+                continue
+
+            x, y, z = player.world_object.position.get()
+            cell = (int(x // self.cell_size), int(y // self.cell_size))
+            self.cells.setdefault(cell, []).append((x, y, z, player))
+
+    def players_near(self, pos: tuple[float, float, float], radius: float):
+        x, y, z = pos
+        sq_radius = radius * radius
+
+        min_cell_x, max_cell_x = int((x - radius) // self.cell_size), int((x + radius) // self.cell_size)
+        min_cell_y, max_cell_y = int((y - radius) // self.cell_size), int((y + radius) // self.cell_size)
+
+        for cell_x in range(min_cell_x, max_cell_x + 1):
+            for cell_y in range(min_cell_y, max_cell_y + 1):
+                for player_x, player_y, player_z, player in self.cells.get((cell_x, cell_y), ()):
+                    if (player_x - x)**2 + (player_y - y)**2 + (player_z - z)**2 < sq_radius:
+                        yield player
+
+    def any_player_near(self, pos: tuple[float, float, float], radius: float) -> bool:
+        for _ in self.players_near(pos, radius):
+            return True
+
+        return False
+
+
+player_grids = WeakKeyDictionary()
+
+
+def get_player_grid(protocol) -> PlayerGrid:
+    grid = player_grids.get(protocol)
+    if grid is None:
+        grid = player_grids[protocol] = PlayerGrid()
+
+    if grid.built_tick != scheduler.ticks:
+        grid.rebuild(protocol.players.values())
+        grid.built_tick = scheduler.ticks
+
+    return grid
@@ -2,6 +2,13 @@ from piqueserver import *
 from piqueserver.commands import command
 import json
 import os
+import sys
+
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+if SCRIPTS_DIRECTORY not in sys.path:
+    sys.path.append(SCRIPTS_DIRECTORY)
+
+from outbound_queue import get_outbound_queue
 
 @command("change_role", admin_only=True)
 def change_role(connection, user: str, _role: str):
@@ -46,7 +53,7 @@ def apply_script(protocol, connection, config):
             if role == None:
                 self.send_chat(f"You don't have a role yet!")
             else:
-                self.protocol.broadcast_chat(f"{name}, {role} connected!")
+                get_outbound_queue(self.protocol).broadcast_chat(f"{name}, {role} connected!")
 
             return connection.on_login(self, name)
 
@@ -1,311 +1,355 @@
-from pyspades.contained import SetColor, BlockAction
-from pyspades.common import Vertex3, make_color
-from pyspades.constants import BUILD_BLOCK, DESTROY_BLOCK
+from pyspades.common import Vertex3
 from piqueserver.commands import command
-from twisted.internet.task import LoopingCall
-from random import randint, choice
-
-
-THE_T = [
-    ((1, 0), (0, -1), (1, -1), (2, -1)),
-    ((1, 0), (1, -2), (1, -1), (2, -1)),
-    ((1, -2), (0, -1), (1, -1), (2, -1)),
-    ((1, 0), (0, -1), (1, -1), (1, -2)),
-    (153, 0, 255)
-]
-
-THE_STICK = [
-    ((0, -1), (1, -1), (2, -1), (3, -1)),
-    ((2, 0), (2, -1), (2, -2), (2, -3)),
-    ((0, -2), (1, -2), (2, -2), (3, -2)),
-    ((1, 0), (1, -1), (1, -2), (1, -3)),
-    (0, 255, 255)
-]
-
-THE_L_LEFT = [
-    ((0, 0), (0, -1), (1, -1), (2, -1)),
-    ((1, 0), (2, 0), (1, -1), (1, -2)),
-    ((0, -1), (1, -1), (2, -1), (2, -2)),
-    ((1, 0), (1, -1), (1, -2), (0, -2)),
-    (0, 0, 255)
-]
-
-THE_L_RIGHT = [
-    ((0, -1), (1, -1), (2, -1), (2, 0)),
-    ((1, 0), (1, -1), (1, -2), (2, -2)),
-    ((0, -2), (0, -1), (1, -1), (2, -1)),
-    ((0, 0), (1, 0), (1, -1), (1, -2)),
-    (255, 170, 0)
-]
-
-THE_SQUARE = [
-    ((0, 0), (1, 0), (1, -1), (0, -1)),
-    ((0, 0), (1, 0), (1, -1), (0, -1)),
-    ((0, 0), (1, 0), (1, -1), (0, -1)),
-    ((0, 0), (1, 0), (1, -1), (0, -1)),
-    (255, 255, 0)
-]
-
-THE_DOG_LEFT = [
-    ((0, -1), (1, 0), (1, -1), (2, 0)),
-    ((1, 0), (1, -1), (2, -1), (2, -2)),
-    ((0, -2), (1, -2), (1, -1), (2, -1)),
-    ((0, 0), (0, -1), (1, -1), (1, -2)),
-    (0, 255, 0)
-]
-
-THE_DOG_RIGHT = [
-    ((0, 0), (1, 0), (1, -1), (2, -1)),
-    ((1, -2), (1, -1), (2, -1), (2, 0)),
-    ((0, -1), (1, -1), (1, -2), (2, -2)),
-    ((0, -2), (0, -1), (1, -1), (1, 0)),
-    (255, 0, 0)
-]
-
-ALL_TETROS = [
-    THE_T, THE_STICK, THE_L_LEFT, THE_L_RIGHT, THE_SQUARE, THE_DOG_LEFT, THE_DOG_RIGHT
-]
-
-SCORE_SINGLE = 100
-SCORE_DOUBLE = 300
-SCORE_TRIPLE = 500
-SCORE_TETRIS = 800
-
-
-class Tetromino:
-    def __init__(self,
-                rotA_points: list[tuple[int, int]],
-                rotB_points: list[tuple[int, int]],
-                rotC_points: list[tuple[int, int]],
-                rotD_points: list[tuple[int, int]], color: tuple[int, int, int], connection):
-
-                self.rotA_points = rotA_points
-                self.rotB_points = rotB_points
-                self.rotC_points = rotC_points
-                self.rotD_points = rotD_points
-
-                self.current_rot = 0
-                self.pos_x = connection.BOARD_W // 2
-                self.pos_y = connection.BOARD_H - 1
-
-                self.color = color
-    
-    def get_offsets(self) -> list[tuple[int, int]]:
-        if self.current_rot == 0: return self.rotA_points
-        if self.current_rot == 1: return self.rotB_points
-        if self.current_rot == 2: return self.rotC_points
-        if self.current_rot == 3: return self.rotD_points
-    
-    def rotate(self, _dir: int) -> None:
-        self.current_rot = (self.current_rot + _dir) % 4
+import os
+import sys
+
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+if SCRIPTS_DIRECTORY not in sys.path:
+    sys.path.append(SCRIPTS_DIRECTORY)
+
+from block_emitter import BlockEmitter
+from framebuffer import FrameBuffer, send_display_snapshots
+from display_scheduler import ScheduledCall
+from perf_stats import get_display_stats, remove_display_stats
+from lag_watchdog import watchdog, GAME_FPS_LEVEL
+from outbound_queue import PRIORITY_GAME
+from tetris_engine import TetrisEngine, BoardView, BOARD_W, BOARD_H
+from tetris_arena import TetrisArena, ARENA_MAX_BOARDS
+from tetris_stats import tetris_stats
+
+GRAVITY_INTERVAL = 0.5  # Secs between two steps down of the falling piece
+MAX_TETRIS_GAMES = 8  # Games running at once on the server
+TETRIS_IDLE_TIMEOUT = 120  # Secs without any move before a game is stopped
+TETRIS_TOP_MAX = 10  # Most players /tetris_top lists
 
 @command("left")
 def left(connection, *args):
     connection.move_left()
+    connection.refresh_after_input()
 
 @command("right")
 def right(connection, *args):
     connection.move_right()
+    connection.refresh_after_input()
 
 @command("up")
 def up(connection, *args):
     connection.rotate_piece()
+    connection.refresh_after_input()
 
 @command("down")
 def down(connection, *args):
     connection.move_down()
+    connection.refresh_after_input()
 
 @command("tetris")
 def tetris(connection, *args):
     x, y, z = connection.get_location()
-    connection.create_tetris(x + 1, y, z)
+    return connection.create_tetris(x + 1, y, z)
+
+@command("tetris_stop")
+def tetris_stop(connection, *args):
+    if connection.game == None:
+        return "You are not playing tetris"
+
+    connection.stop_tetris()
+    return "Tetris stopped"
+
+@command("tetris_top")
+def tetris_top(connection, count: str = "5"):
+    try:
+        count = max(1, min(int(count), TETRIS_TOP_MAX))
+    except ValueError:
+        return "Usage: /tetris_top [number of players]"
+
+    top = tetris_stats.get_top(count)
+    if not top:
+        return "Nobody played tetris yet"
+
+    lines = [f"{rank}. {name} {stats['best_score']}" for rank, (name, stats) in enumerate(top, 1)]
+
+    stats = tetris_stats.players.get(connection.name)
+    if stats != None:
+        lines.append(
+            f"You: #{tetris_stats.get_rank(connection.name)}, best {stats['best_score']}, {stats['lines']} lines, "
+            f"{stats['games']} games, {tetris_stats.get_pieces_per_minute(stats):.1f} pieces/min"
+        )
+
+    return "\n".join(lines)
+
+@command("arena_create")
+def arena_create(connection, *args):
+    if connection.protocol.tetris_arena != None:
+        return "There is already a tetris arena, use /arena_delete to remove it"
+
+    x, y, z = connection.get_location()
+    connection.protocol.tetris_arena = TetrisArena(connection.protocol, (x + 1, y, z))
+    return "Tetris arena created! Players use /arena_join to play and /arena_start to begin"
+
+@command("arena_delete")
+def arena_delete(connection, *args):
+    if connection.protocol.tetris_arena == None:
+        return "There is no tetris arena"
+
+    connection.protocol.tetris_arena.delete()
+    connection.protocol.tetris_arena = None
+    return "Tetris arena deleted"
+
+@command("arena_join")
+def arena_join(connection, *args):
+    arena = connection.protocol.tetris_arena
+    if arena == None:
+        return "There is no tetris arena, use /arena_create to make one"
+
+    if arena.running:
+        return "The arena already started, use /arena_spectate to watch it"
+
+    if connection.game != None:
+        return "Stop your tetris game first with /tetris_stop"
+
+    if connection in arena.players:
+        return "You already joined the arena"
+
+    if len(arena.players) >= ARENA_MAX_BOARDS:
+        return f"The arena is full ({ARENA_MAX_BOARDS} players)"
+
+    arena.join(connection)
+    return f"You joined the tetris arena ({len(arena.players)} players), use /arena_start to begin"
+
+@command("arena_leave")
+def arena_leave(connection, *args):
+    arena = connection.protocol.tetris_arena
+    if arena == None or connection not in arena.players:
+        return "You are not in the tetris arena"
+
+    arena.leave(connection)
+    return "You left the tetris arena"
+
+@command("arena_start")
+def arena_start(connection, *args):
+    arena = connection.protocol.tetris_arena
+    if arena == None:
+        return "There is no tetris arena, use /arena_create to make one"
+
+    if arena.running:
+        return "The arena already started"
+
+    if not arena.players:
+        return "Nobody joined the arena yet, use /arena_join"
+
+    arena.start()
+
+@command("arena_spectate")
+def arena_spectate(connection, *args):
+    arena = connection.protocol.tetris_arena
+    if arena == None:
+        return "There is no tetris arena"
+
+    if arena.spectate(connection):
+        return "You are spectating the tetris arena, use /arena_spectate again to stop"
+
+    return "You stopped spectating the tetris arena"
 
 def apply_script(protocol, connection, config):
+    class TetrisProtocol(protocol):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+
+            self.tetris_players = set()
+            self.tetris_arena = None
+
+            # Screens and engines of stopped games, the next games reuse them instead of allocating new ones
+            self.free_tetris_screens = []
+            self.free_tetris_engines = []
+
+        def get_tetris_screen(self, to_world) -> FrameBuffer:
+            emitter = BlockEmitter(self)
+            if self.free_tetris_screens:
+                screen = self.free_tetris_screens.pop()
+                screen.open(to_world, world_color=(255, 255, 255), emitter=emitter)
+                return screen
+
+            return FrameBuffer(BOARD_W, BOARD_H, to_world, emitter, world_color=(255, 255, 255))
+
+        def get_tetris_engine(self, listener) -> TetrisEngine:
+            if self.free_tetris_engines:
+                game = self.free_tetris_engines.pop()
+                game.listener = listener
+                game.new_game()
+                return game
+
+            return TetrisEngine(listener=listener)
+
+        def release_tetris(self, screen: FrameBuffer, game: TetrisEngine) -> None:
+            game.listener = None
+            self.free_tetris_screens.append(screen)
+            self.free_tetris_engines.append(game)
+
     class TetrisConnection(connection):
         start_position = None
-        block_placed = False
-
-        SCREEN_W = 10
-        SCREEN_H = 24
 
-        BOARD_W = 10
-        BOARD_H = 24
-        screen_pixels = []
-        world_pixels = []
-        board = []
-        score = 0
+        screen = None
+        game = None  # TetrisEngine, drawn on the screen by a BoardView
+        loop = None
+        idle_ticks = 0  # Gravity steps since the last move
+        game_over = False
 
-        current_piece = None
+        def on_join(self) -> None:
+            send_display_snapshots(self)
+            return connection.on_join(self)
 
         def on_spawn(self, pos) -> None:
-            self.send_chat("Generated screen pixels")
-            self.screen_pixels = [[(0, 0, 0) for y in range(self.SCREEN_H)] for x in range(self.SCREEN_W)]
-            self.world_pixels = [[(255, 255, 255) for y in range(self.SCREEN_H)] for x in range(self.SCREEN_W)]
-            self.board = [[(0, 0, 0) for y in range(self.BOARD_H)] for x in range(self.BOARD_W)]
+            # Respawning starts a new game
+            if self.game != None:
+                tetris_stats.record_game(self.name, self.game, GRAVITY_INTERVAL)
+                self.game.new_game()
+                self.refresh_screen()
 
             return connection.on_spawn(self, pos)
-        
-        def create_piece(self, piece: Tetromino) -> None:
-            self.current_piece = piece
-
-        def rotate_piece(self) -> None:
-            if self.current_piece != None:
-                self.current_piece.rotate(1)
-                if not self.is_dir_safe(0, 0):
-                    self.current_piece.rotate(-1)
-
-        def create_tetris(self, x: int, y: int, z: int) -> None:
-            if self.block_placed:
-                return None
+
+        def on_disconnect(self) -> None:
+            self.stop_tetris()
+            if self.protocol.tetris_arena != None:
+                self.protocol.tetris_arena.leave(self)
+
+            return connection.on_disconnect(self)
+
+        def create_tetris(self, x: int, y: int, z: int) -> str:
+            if self.game != None:
+                return "You are already playing tetris, use /tetris_stop to end the game"
+
+            if self.protocol.tetris_arena != None and self in self.protocol.tetris_arena.players:
+                return "You are in the tetris arena, use /arena_leave first"
+
+            if len(self.protocol.tetris_players) >= MAX_TETRIS_GAMES:
+                return f"There are already {MAX_TETRIS_GAMES} tetris games running, try again later"
 
             self.start_position = Vertex3()
             self.start_position.x = x
             self.start_position.y = y
             self.start_position.z = z
 
-            self.block_placed = True
             self.ticks = 0
+            self.idle_ticks = 0
+            self.game_over = False
+            self.protocol.tetris_players.add(self)
+
+            self.screen = self.protocol.get_tetris_screen(self.screen_to_world)
+            self.perf = get_display_stats(f"tetris-{self.player_id}")
+            self.screen.emitter.perf = self.perf
+            self.screen.emitter.priority = PRIORITY_GAME
 
-            self.create_piece(Tetromino(*choice(ALL_TETROS), self))
+            self.game = self.protocol.get_tetris_engine(BoardView(self.screen, on_game_over=self.on_game_over))
+            self.refresh_screen()
 
-            self.loop = LoopingCall(self.refresh_screen)
-            FPS = 20
-            self.loop.start(1 / FPS)
+            # Nothing changes between two gravity steps unless the player moves, which redraws right away
+            self.loop = ScheduledCall(self.perf.measure(self.game_tick, GRAVITY_INTERVAL))
+            self.loop.start(GRAVITY_INTERVAL, now=False)
 
-        def is_out_of_board(self, x: int, y: int) -> bool:
-            return (x < 0 or y < 0 or x > self.BOARD_W - 1 or y > self.BOARD_H - 1)
+            return "Tetris started! Use /left, /right, /up and /down to play"
 
-        def is_dir_safe(self, x: int, y: int) -> bool:
-            for offset in self.current_piece.get_offsets():
-                board_x = self.current_piece.pos_x + offset[0] + x
-                board_y = self.current_piece.pos_y + offset[1] + y
+        def stop_tetris(self) -> None:
+            if self.game == None:
+                return None
 
-                if self.is_out_of_board(board_x, board_y):
-                    return False
-                
-                if self.board[board_x][board_y] != (0, 0, 0):
-                    return False
+            if self.loop.running:
+                self.loop.stop()
+
+            # Game overs are already counted
+            if not self.game_over:
+                tetris_stats.record_game(self.name, self.game, GRAVITY_INTERVAL)
+
+            self.screen.clear()
+            remove_display_stats(self.perf.name)
+
+            self.protocol.release_tetris(self.screen, self.game)
+            self.protocol.tetris_players.discard(self)
+
+            self.screen = None
+            self.game = None
+            self.start_position = None
+
+        def get_played_game(self) -> TetrisEngine:
+            # The player's own game, or their board in the arena
+            if self.game != None:
+                return self.game
+
+            if self.protocol.tetris_arena != None:
+                board = self.protocol.tetris_arena.get_board(self)
+                if board != None:
+                    return board.game
+
+            return None
+
+        def rotate_piece(self) -> bool:
+            game = self.get_played_game()
+            if game == None:
+                return False
+
+            self.idle_ticks = 0
+            return game.rotate_piece()
 
-            
-            return True
-        
         def move_left(self) -> bool:
-            if self.is_dir_safe(-1, 0):
-                self.current_piece.pos_x -= 1
-                return True
-            return False
-        
+            game = self.get_played_game()
+            if game == None:
+                return False
+
+            self.idle_ticks = 0
+            return game.move_left()
+
         def move_right(self) -> bool:
-            if self.is_dir_safe(1, 0):
-                self.current_piece.pos_x += 1
-                return True
-            return False
-            
+            game = self.get_played_game()
+            if game == None:
+                return False
+
+            self.idle_ticks = 0
+            return game.move_right()
+
         def move_down(self) -> bool:
-            if self.is_dir_safe(0, -1):
-                self.current_piece.pos_y -= 1
-                return True
-            return False
-        
+            game = self.get_played_game()
+            if game == None:
+                return False
+
+            self.idle_ticks = 0
+            return game.move_down()
+
         def game_tick(self) -> None:
             self.ticks += 1
+            self.idle_ticks += 1
 
-            if self.ticks % 10 == 0:
-                if not self.move_down():
-                    self.lock_current_piece()
-                    self.create_piece(Tetromino(*choice(ALL_TETROS), self))
-        
-        def lock_current_piece(self) -> None:
-            for offset in self.current_piece.get_offsets():
-                self.board[self.current_piece.pos_x + offset[0]][self.current_piece.pos_y + offset[1]] = self.current_piece.color
-
-                if offset[1] + self.current_piece.pos_y >= (self.BOARD_H - 1):
-                    self.end_game()
-        
-        def end_game(self) -> None:
-            self.free_board()
-            self.send_chat(f"Game finished. Score: {self.score} !")
-            self.score = 0
-        
-        def free_board(self) -> None:
-            for x in range(self.BOARD_W):
-                for y in range(self.BOARD_H):
-                    self.board[x][y] = (0, 0, 0)
-        
-        def pixel_in_current_piece(self, pixel_x: int, pixel_y: int) -> bool:
-            for offset in self.current_piece.get_offsets():
-                if (pixel_x, pixel_y) == (offset[0] + self.current_piece.pos_x, offset[1] + self.current_piece.pos_y):
-                    return True
-            
-            return False
-        
-        def update_screen(self) -> None:
-            for x in range(self.SCREEN_W):
-                for y in range(self.SCREEN_H):
-                    self.screen_pixels[x][y] = self.board[x][y]
-
-                    # Piece
-                    if self.pixel_in_current_piece(x, y):
-                        self.screen_pixels[x][y] = self.current_piece.color
-        
-        def remove_row(self, row: int) -> None:
-            for y in range(row, self.BOARD_H):
-                for x in range(0, self.BOARD_W):
-                    if not self.is_out_of_board(x, y + 1):
-                        self.board[x][y] = self.board[x][y + 1]
-                    else:
-                        self.board[x][y] = (0, 0, 0)
-        
-        def update_board(self) -> None:
-            tot_removed_rows = 0
-            for y in range(self.BOARD_H - 1, -1, -1):
-                tot_empty = 0
-                for x in range(0, self.BOARD_W):
-                    if self.board[x][y] == (0, 0, 0):
-                        tot_empty += 1
-
-                if tot_empty == 0:
-                    self.remove_row(y)
-                    tot_removed_rows += 1
-            
-            if tot_removed_rows == 1: self.score += SCORE_SINGLE
-            if tot_removed_rows == 2: self.score += SCORE_DOUBLE
-            if tot_removed_rows == 3: self.score += SCORE_TRIPLE
-            if tot_removed_rows == 4: self.score += SCORE_TETRIS
+            if self.idle_ticks * GRAVITY_INTERVAL >= TETRIS_IDLE_TIMEOUT:
+                self.send_chat(f"Tetris stopped after {TETRIS_IDLE_TIMEOUT} secs without a move, use /tetris to play again")
+                self.stop_tetris()
+                return None
+
+            self.game.step()
+
+            if self.game_over:
+                self.stop_tetris()
+                return None
+
+            self.refresh_screen()
+
+        def on_game_over(self, game: TetrisEngine) -> None:
+            # The game is stopped once the engine is done with it, see game_tick()
+            self.game_over = True
+            tetris_stats.record_game(self.name, game, GRAVITY_INTERVAL)
+            self.send_chat(f"Game finished. Score: {game.score} ! Use /tetris to play again")
+
+        def screen_to_world(self, x: int, y: int) -> tuple[int, int, int]:
+            return (self.start_position.x + x, self.start_position.y, self.start_position.z - y)
 
         def refresh_screen(self) -> None:
-            self.game_tick()
-            self.update_board()
-            self.update_screen()
-            if self.start_position == None:
+            if self.game == None:
                 return None
+
+            self.screen.refresh()
+
+        def refresh_after_input(self) -> None:
+            # Under lag, moves are only shown with the next gravity step
+            if watchdog.level >= GAME_FPS_LEVEL:
+                return None
+
+            self.refresh_screen()
             
-            for x in range(self.SCREEN_W):
-                for y in range(self.SCREEN_H):
-                    pixel = self.screen_pixels[x][y]
-
-                    if self.world_pixels[x][y] == self.screen_pixels[x][y]:
-                        continue
-                    
-                    pixel_x = self.start_position.x + x
-                    pixel_y = self.start_position.y
-                    pixel_z = self.start_position.z - y
-                    
-                    set_color = SetColor()
-                    set_color.value = make_color(*pixel)
-                    set_color.player_id = 32
-
-                    self.world_pixels[x][y] = self.screen_pixels[x][y]
-
-                    self.protocol.broadcast_contained(set_color, save=True)
-
-                    build = BlockAction()
-                    build.x = pixel_x
-                    build.y = pixel_y
-                    build.z = pixel_z
-                    build.player_id = 32
-                    build.value = BUILD_BLOCK
-
-                    self.protocol.broadcast_contained(build, save=True)
-            
-    return protocol, TetrisConnection
\ No newline at end of file
+    return TetrisProtocol, TetrisConnection
\ No newline at end of file
@@ -0,0 +1,226 @@
+import random
+
+from block_emitter import BlockEmitter
+from framebuffer import FrameBuffer
+from display_scheduler import ScheduledCall
+from perf_stats import get_display_stats, remove_display_stats
+from lag_watchdog import watchdog, GAME_FPS_LEVEL
+from outbound_queue import PRIORITY_GAME
+from tetris_engine import TetrisEngine, BoardView, BOARD_W, BOARD_H
+from tetris_stats import tetris_stats
+
+# Tetris arena: many boards side by side for tournaments, their games count in the tetris stats
+# The /arena_* commands are in tetris.py
+# Every board is ticked by the arena's single ScheduledCall and drawn on one shared framebuffer, so an arena tick
+# sends one update for all boards, grouped by color by the emitter. Moves are shown with the next arena tick.
+# All boards get the same pieces. Clearing 2 lines or more sends garbage rows to the next board still playing
+
+ARENA_TICK_INTERVAL = 0.05  # Secs between two redraws of the arena
+ARENA_GRAVITY_TICKS = 10  # Arena ticks between two steps down of the falling pieces
+ARENA_MAX_BOARDS = 24
+ARENA_BOARD_GAP = 2  # Empty columns between two boards
+ARENA_GARBAGE_ROWS = (0, 0, 1, 2, 4)  # Garbage rows sent for 0, 1, 2, 3 and 4 cleared lines
+ARENA_SPECTATOR_DISTANCE = 30  # Spectators are put this many blocks in front of the arena
+
+
+class ArenaScreen(FrameBuffer):
+    def __init__(self, arena, width: int, height: int, to_world, emitter) -> None:
+        self.arena = arena
+        super().__init__(width, height, to_world, emitter, world_color=(255, 255, 255))
+
+    def get_viewers(self, distance: float) -> set:
+        # Players and spectators see the arena from anywhere
+        viewers = super().get_viewers(distance)
+        viewers.update(self.arena.spectators)
+        viewers.update(board.player for board in self.arena.boards)
+        return viewers
+
+
+class ArenaBoard:
+    def __init__(self, arena, player, offset_x: int, seed: int) -> None:
+        self.arena = arena
+        self.player = player
+        self.alive = True
+
+        self.view = BoardView(arena.screen, offset_x, on_game_over=self.on_game_over)
+        self.game = TetrisEngine(seed, listener=self.view)
+
+    def on_game_over(self, game: TetrisEngine) -> None:
+        # The engine starts a new game right away, the board keeps showing the one that ended
+        self.alive = False
+        self.score = game.score
+        game.listener = None
+        tetris_stats.record_game(self.player.name, game, ARENA_TICK_INTERVAL * ARENA_GRAVITY_TICKS)
+        self.arena.send_chat(f"{self.player.name} is out with {game.score} points")
+
+    def get_score(self) -> int:
+        if self.alive:
+            return self.game.score
+
+        return self.score
+
+
+class TetrisArena:
+    def __init__(self, protocol, position: tuple[int, int, int]) -> None:
+        self.protocol = protocol
+        self.position = position
+
+        self.players = []  # Joined for the next round
+        self.spectators = set()
+        self.boards: list[ArenaBoard] = []  # Boards of the current or last round, in screen order
+
+        self.screen = None
+        self.running = False
+        self.ticks = 0
+        self.random = None  # Garbage holes
+
+        self.perf = get_display_stats("tetris_arena")
+        self.loop = ScheduledCall(self.perf.measure(self.tick, ARENA_TICK_INTERVAL))
+
+    def to_world(self, x: int, y: int) -> tuple[int, int, int]:
+        return (self.position[0] + x, self.position[1], self.position[2] - y)
+
+    def send_chat(self, message: str) -> None:
+        for player in set(self.players) | self.spectators:
+            player.send_chat(message)
+
+    def join(self, player) -> None:
+        if player not in self.players:
+            self.players.append(player)
+
+    def leave(self, player) -> None:
+        if player in self.players:
+            self.players.remove(player)
+
+        self.spectators.discard(player)
+
+        for board in self.boards:
+            if board.player is player and board.alive and self.running:
+                board.game.end_game()
+                self.check_end()
+
+    def spectate(self, player) -> bool:
+        # Toggles, True if the player is spectating now
+        if player in self.spectators:
+            self.spectators.discard(player)
+            return False
+
+        self.spectators.add(player)
+
+        if self.screen is not None:
+            x, y, z = self.screen.get_center()
+            player.set_location_safe((x, y + ARENA_SPECTATOR_DISTANCE, z))
+
+        return True
+
+    def get_board(self, player) -> ArenaBoard:
+        for board in self.boards:
+            if board.player is player and board.alive and self.running:
+                return board
+
+        return None
+
+    def start(self) -> None:
+        if self.screen is not None:
+            self.screen.clear()
+
+        emitter = BlockEmitter(self.protocol)
+        emitter.perf = self.perf
+        emitter.priority = PRIORITY_GAME
+
+        # The boards are created below, the screen only reads them once refreshed
+        self.boards = []
+        width = len(self.players) * (BOARD_W + ARENA_BOARD_GAP) - ARENA_BOARD_GAP
+        self.screen = ArenaScreen(self, width, BOARD_H, self.to_world, emitter)
+
+        # Gaps are white like the world the screen starts from, so they are never built
+        for board_idx in range(1, len(self.players)):
+            self.screen.rect((board_idx * (BOARD_W + ARENA_BOARD_GAP) - ARENA_BOARD_GAP, 0, ARENA_BOARD_GAP, BOARD_H), (255, 255, 255))
+
+        seed = random.getrandbits(32)
+        self.random = random.Random(seed)
+        self.boards = [ArenaBoard(self, player, player_idx * (BOARD_W + ARENA_BOARD_GAP), seed) for player_idx, player in enumerate(self.players)]
+
+        self.ticks = 0
+        self.running = True
+        if not self.loop.running:
+            self.loop.start(ARENA_TICK_INTERVAL, now=False)
+
+        self.send_chat(f"Tetris arena started with {len(self.boards)} players!")
+
+    def tick(self) -> None:
+        # Once a round is over, players coming closer or spectating still get the final boards
+        if not self.running:
+            self.screen.update_viewers()
+            return None
+
+        self.ticks += 1
+
+        if self.ticks % ARENA_GRAVITY_TICKS == 0:
+            self.gravity_step()
+
+        if not watchdog.skip_frame(GAME_FPS_LEVEL, self.ticks):
+            self.screen.refresh()
+
+    def gravity_step(self) -> None:
+        garbage = []
+
+        for board in self.boards:
+            if not board.alive:
+                continue
+
+            lines = board.game.lines
+            board.game.step()
+
+            if board.alive and board.game.lines > lines:
+                rows = ARENA_GARBAGE_ROWS[min(board.game.lines - lines, len(ARENA_GARBAGE_ROWS) - 1)]
+                if rows > 0:
+                    garbage.append((board, rows))
+
+        # Sent once every board moved, so the board order doesn't matter
+        for board, rows in garbage:
+            target = self.get_next_board(board)
+            if target is not None:
+                target.game.add_garbage(rows, self.random.randrange(BOARD_W))
+
+        self.check_end()
+
+    def get_next_board(self, board: ArenaBoard) -> ArenaBoard:
+        board_idx = self.boards.index(board)
+
+        for offset in range(1, len(self.boards)):
+            target = self.boards[(board_idx + offset) % len(self.boards)]
+            if target.alive:
+                return target
+
+        return None
+
+    def check_end(self) -> None:
+        # A round ends when one player is left, or nobody when playing alone
+        alive = [board for board in self.boards if board.alive]
+        if len(alive) > 1 or (len(alive) == 1 and len(self.boards) == 1):
+            return None
+
+        # The loop keeps going while the final boards are up, see tick()
+        self.running = False
+        self.screen.refresh()
+
+        for board in alive:
+            board.game.listener = None
+            board.score = board.game.score
+            tetris_stats.record_game(board.player.name, board.game, ARENA_TICK_INTERVAL * ARENA_GRAVITY_TICKS)
+            board.alive = False
+            self.send_chat(f"{board.player.name} wins the tetris arena!")
+
+        ranking = sorted(self.boards, key=lambda board: board.get_score(), reverse=True)
+        self.send_chat("Scores: " + ", ".join(f"{board.player.name} {board.get_score()}" for board in ranking))
+
+    def delete(self) -> None:
+        self.running = False
+        if self.loop.running:
+            self.loop.stop()
+
+        if self.screen is not None:
+            self.screen.clear()
+
+        remove_display_stats(self.perf.name)
@@ -0,0 +1,444 @@
+import random
+
+# Tetris game logic, no server needed
+# tetris.py shows it in game, benchmarks and tools can use it directly.
+# A game is fully defined by its seed and its inputs (see get_replay()), so any game can be replayed and its score checked.
+# Whoever shows the game gets told what changed through the listener: on_piece_moved(engine), on_rows_moved(engine, from_row)
+# for cleared rows and garbage, on_board_reset(engine) and on_game_over(engine), called before the next game starts.
+# BoardView is such a listener, drawing the game on a screen
+
+
+THE_T = [
+    ((1, 0), (0, -1), (1, -1), (2, -1)),
+    ((1, 0), (1, -2), (1, -1), (2, -1)),
+    ((1, -2), (0, -1), (1, -1), (2, -1)),
+    ((1, 0), (0, -1), (1, -1), (1, -2)),
+    (153, 0, 255)
+]
+
+THE_STICK = [
+    ((0, -1), (1, -1), (2, -1), (3, -1)),
+    ((2, 0), (2, -1), (2, -2), (2, -3)),
+    ((0, -2), (1, -2), (2, -2), (3, -2)),
+    ((1, 0), (1, -1), (1, -2), (1, -3)),
+    (0, 255, 255)
+]
+
+THE_L_LEFT = [
+    ((0, 0), (0, -1), (1, -1), (2, -1)),
+    ((1, 0), (2, 0), (1, -1), (1, -2)),
+    ((0, -1), (1, -1), (2, -1), (2, -2)),
+    ((1, 0), (1, -1), (1, -2), (0, -2)),
+    (0, 0, 255)
+]
+
+THE_L_RIGHT = [
+    ((0, -1), (1, -1), (2, -1), (2, 0)),
+    ((1, 0), (1, -1), (1, -2), (2, -2)),
+    ((0, -2), (0, -1), (1, -1), (2, -1)),
+    ((0, 0), (1, 0), (1, -1), (1, -2)),
+    (255, 170, 0)
+]
+
+THE_SQUARE = [
+    ((0, 0), (1, 0), (1, -1), (0, -1)),
+    ((0, 0), (1, 0), (1, -1), (0, -1)),
+    ((0, 0), (1, 0), (1, -1), (0, -1)),
+    ((0, 0), (1, 0), (1, -1), (0, -1)),
+    (255, 255, 0)
+]
+
+THE_DOG_LEFT = [
+    ((0, -1), (1, 0), (1, -1), (2, 0)),
+    ((1, 0), (1, -1), (2, -1), (2, -2)),
+    ((0, -2), (1, -2), (1, -1), (2, -1)),
+    ((0, 0), (0, -1), (1, -1), (1, -2)),
+    (0, 255, 0)
+]
+
+THE_DOG_RIGHT = [
+    ((0, 0), (1, 0), (1, -1), (2, -1)),
+    ((1, -2), (1, -1), (2, -1), (2, 0)),
+    ((0, -1), (1, -1), (1, -2), (2, -2)),
+    ((0, -2), (0, -1), (1, -1), (1, 0)),
+    (255, 0, 0)
+]
+
+ALL_TETROS = [
+    THE_T, THE_STICK, THE_L_LEFT, THE_L_RIGHT, THE_SQUARE, THE_DOG_LEFT, THE_DOG_RIGHT
+]
+
+SCORE_SINGLE = 100
+SCORE_DOUBLE = 300
+SCORE_TRIPLE = 500
+SCORE_TETRIS = 800
+
+EMPTY_COLOR = (0, 0, 0)
+GARBAGE_COLOR = (128, 128, 128)
+
+BOARD_W = 10
+BOARD_H = 24
+
+# Replay inputs, one character each
+INPUT_LEFT = "l"
+INPUT_RIGHT = "r"
+INPUT_ROTATE = "u"
+INPUT_DOWN = "d"
+INPUT_GRAVITY = "g"
+INPUT_GARBAGE = "A"  # One garbage row with its hole at x is chr(ord("A") + x)
+
+
+def compute_piece_mask(points: tuple[tuple[int, int], ...]) -> tuple[int, int, int, int, list[tuple[int, int]]]:
+    # (min x, max x, min y, max y, [(y offset, bits of the x offsets on that row)]) of one piece rotation
+    row_masks = {}
+    for x, y in points:
+        row_masks[y] = row_masks.get(y, 0) | (1 << x)
+
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    return min(xs), max(xs), min(ys), max(ys), list(row_masks.items())
+
+
+# Rotation points -> mask, for every rotation of every piece
+PIECE_MASKS = {points: compute_piece_mask(points) for tetro in ALL_TETROS for points in tetro[:4]}
+
+
+class Tetromino:
+    def __init__(self,
+                rotA_points: list[tuple[int, int]],
+                rotB_points: list[tuple[int, int]],
+                rotC_points: list[tuple[int, int]],
+                rotD_points: list[tuple[int, int]], color: tuple[int, int, int], board_w: int = BOARD_W, board_h: int = BOARD_H):
+
+                self.rotA_points = rotA_points
+                self.rotB_points = rotB_points
+                self.rotC_points = rotC_points
+                self.rotD_points = rotD_points
+
+                self.current_rot = 0
+                self.pos_x = board_w // 2
+                self.pos_y = board_h - 1
+
+                self.color = color
+    
+    def get_offsets(self) -> list[tuple[int, int]]:
+        if self.current_rot == 0: return self.rotA_points
+        if self.current_rot == 1: return self.rotB_points
+        if self.current_rot == 2: return self.rotC_points
+        if self.current_rot == 3: return self.rotD_points
+    
+    def get_mask(self) -> tuple[int, int, int, int, list[tuple[int, int]]]:
+        return PIECE_MASKS[self.get_offsets()]
+
+    def rotate(self, _dir: int) -> None:
+        self.current_rot = (self.current_rot + _dir) % 4
+
+
+class TetrisEngine:
+    def __init__(self, seed: int = None, board_w: int = BOARD_W, board_h: int = BOARD_H, listener=None) -> None:
+        self.board_w = board_w
+        self.board_h = board_h
+        self.full_row = (1 << board_w) - 1
+        self.empty_row = [EMPTY_COLOR] * board_w
+        self.listener = listener
+
+        self.board_rows = [0] * board_h  # One int per row, bit x is set when the cell is taken
+        self.board_colors = [[EMPTY_COLOR] * board_w for _ in range(board_h)]  # board_colors[y][x] -> color of the cell
+        self.score = 0
+        self.lines = 0
+        self.pieces = 0
+        self.steps = 0  # Gravity steps, the game lasted steps times the gravity interval
+        self.current_piece = None
+        self.last_score = None  # Score of the previous game
+
+        self.seed = None
+        self.pieces_random = None
+        self.inputs = []
+
+        self.new_game(seed)
+
+    def new_game(self, seed: int = None) -> None:
+        # Every game gets its own seed so it can be replayed on its own
+        if seed is None:
+            seed = random.getrandbits(32)
+
+        self.seed = seed
+        self.pieces_random = random.Random(seed)
+        self.inputs = []
+
+        self.score = 0
+        self.lines = 0
+        self.pieces = 0
+        self.steps = 0
+        self.free_board()
+        self.spawn_piece()
+
+        if self.listener is not None:
+            self.listener.on_board_reset(self)
+
+    def free_board(self) -> None:
+        # In place, engines are reused from game to game
+        for y in range(self.board_h):
+            self.board_rows[y] = 0
+            self.board_colors[y][:] = self.empty_row
+
+    def spawn_piece(self) -> None:
+        self.current_piece = Tetromino(*self.pieces_random.choice(ALL_TETROS), self.board_w, self.board_h)
+        self.pieces += 1
+
+        if self.listener is not None:
+            self.listener.on_piece_moved(self)
+
+    def get_piece_cells(self) -> set[tuple[int, int]]:
+        return {(self.current_piece.pos_x + offset[0], self.current_piece.pos_y + offset[1]) for offset in self.current_piece.get_offsets()}
+
+    def is_out_of_board(self, x: int, y: int) -> bool:
+        return (x < 0 or y < 0 or x > self.board_w - 1 or y > self.board_h - 1)
+
+    def is_dir_safe(self, x: int, y: int) -> bool:
+        min_x, max_x, min_y, max_y, row_masks = self.current_piece.get_mask()
+        pos_x = self.current_piece.pos_x + x
+        pos_y = self.current_piece.pos_y + y
+
+        if self.is_out_of_board(pos_x + min_x, pos_y + min_y) or self.is_out_of_board(pos_x + max_x, pos_y + max_y):
+            return False
+
+        for offset_y, mask in row_masks:
+            if self.board_rows[pos_y + offset_y] & (mask << pos_x if pos_x >= 0 else mask >> -pos_x):
+                return False
+
+        return True
+
+    def move(self, x: int, y: int) -> bool:
+        if not self.is_dir_safe(x, y):
+            return False
+
+        self.current_piece.pos_x += x
+        self.current_piece.pos_y += y
+
+        if self.listener is not None:
+            self.listener.on_piece_moved(self)
+
+        return True
+
+    def move_left(self) -> bool:
+        self.inputs.append(INPUT_LEFT)
+        return self.move(-1, 0)
+
+    def move_right(self) -> bool:
+        self.inputs.append(INPUT_RIGHT)
+        return self.move(1, 0)
+
+    def move_down(self) -> bool:
+        self.inputs.append(INPUT_DOWN)
+        return self.move(0, -1)
+
+    def rotate_piece(self) -> bool:
+        self.inputs.append(INPUT_ROTATE)
+
+        self.current_piece.rotate(1)
+        if not self.is_dir_safe(0, 0):
+            self.current_piece.rotate(-1)
+            return False
+
+        if self.listener is not None:
+            self.listener.on_piece_moved(self)
+
+        return True
+
+    def step(self) -> None:
+        # Gravity: the piece falls by one, or locks and the next one comes in
+        self.inputs.append(INPUT_GRAVITY)
+        self.steps += 1
+
+        if self.move(0, -1):
+            return None
+
+        if self.lock_current_piece():
+            self.end_game()
+            return None
+
+        self.update_board()
+        self.spawn_piece()
+
+    def apply_input(self, key: str) -> None:
+        if key == INPUT_LEFT:
+            self.move_left()
+        elif key == INPUT_RIGHT:
+            self.move_right()
+        elif key == INPUT_ROTATE:
+            self.rotate_piece()
+        elif key == INPUT_DOWN:
+            self.move_down()
+        elif key == INPUT_GRAVITY:
+            self.step()
+        elif INPUT_GARBAGE <= key < chr(ord(INPUT_GARBAGE) + self.board_w):
+            self.add_garbage_row(ord(key) - ord(INPUT_GARBAGE))
+        else:
+            raise ValueError(f"Unknown tetris input {key!r}")
+
+    def lock_current_piece(self) -> bool:
+        # True if the piece reached the top row, which ends the game
+        reached_top = False
+
+        for x, y in self.get_piece_cells():
+            self.board_rows[y] |= 1 << x
+            self.board_colors[y][x] = self.current_piece.color
+
+            if y >= (self.board_h - 1):
+                reached_top = True
+
+        return reached_top
+
+    def remove_row(self, row: int) -> None:
+        # Rows above fall by one, an empty row comes in at the top
+        del self.board_rows[row]
+        row_colors = self.board_colors.pop(row)
+
+        row_colors[:] = self.empty_row
+        self.board_rows.append(0)
+        self.board_colors.append(row_colors)
+
+    def update_board(self) -> None:
+        tot_removed_rows = 0
+        lowest_removed_row = None
+        for y in range(self.board_h - 1, -1, -1):
+            if self.board_rows[y] == self.full_row:
+                self.remove_row(y)
+                tot_removed_rows += 1
+                lowest_removed_row = y
+
+        if tot_removed_rows == 1: self.score += SCORE_SINGLE
+        if tot_removed_rows == 2: self.score += SCORE_DOUBLE
+        if tot_removed_rows == 3: self.score += SCORE_TRIPLE
+        if tot_removed_rows == 4: self.score += SCORE_TETRIS
+        self.lines += tot_removed_rows
+
+        # Every row from the lowest cleared one up moved
+        if lowest_removed_row != None and self.listener is not None:
+            self.listener.on_rows_moved(self, lowest_removed_row)
+
+    def add_garbage(self, rows: int, hole_x: int) -> None:
+        # Full rows but one hole come in at the bottom and push the board up, multiplayer games send them to each other.
+        # One row at a time, exactly like the one input per row a replay plays
+        seed = self.seed
+        for _ in range(rows):
+            if self.seed != seed:
+                return None
+
+            self.add_garbage_row(hole_x)
+
+    def add_garbage_row(self, hole_x: int) -> None:
+        self.inputs.append(chr(ord(INPUT_GARBAGE) + hole_x))
+
+        # Blocks pushed out of the top end the game
+        if self.board_rows[-1]:
+            self.end_game()
+            return None
+
+        self.board_rows.pop()
+        row_colors = self.board_colors.pop()
+
+        row_colors[:] = [GARBAGE_COLOR] * self.board_w
+        row_colors[hole_x] = EMPTY_COLOR
+        self.board_rows.insert(0, self.full_row & ~(1 << hole_x))
+        self.board_colors.insert(0, row_colors)
+
+        # The falling piece goes up with the board if it's in the way, or the game is over
+        if not self.is_dir_safe(0, 0):
+            self.current_piece.pos_y += 1
+            if not self.is_dir_safe(0, 0):
+                self.end_game()
+                return None
+
+        # Redrawing the rows covers the piece, it is drawn again on top
+        if self.listener is not None:
+            self.listener.on_rows_moved(self, 0)
+            self.listener.on_piece_moved(self)
+
+    def end_game(self) -> None:
+        if self.listener is not None:
+            self.listener.on_game_over(self)
+
+        self.last_score = self.score
+        self.new_game()
+
+    def get_replay(self) -> dict:
+        # Everything needed to play the current game again, JSON friendly
+        return {
+            "seed": self.seed,
+            "board_w": self.board_w,
+            "board_h": self.board_h,
+            "inputs": "".join(self.inputs),
+        }
+
+
+class BoardView:
+    # Listener drawing a game on a screen (anything with set_at((x, y), color), like a FrameBuffer), `offset_x` columns from its left
+    def __init__(self, screen, offset_x: int = 0, on_game_over=None) -> None:
+        self.screen = screen
+        self.offset_x = offset_x
+        self.game_over_callback = on_game_over  # Called with the engine
+
+        self.piece_cells = set()  # Board cells the falling piece was last drawn on
+
+    def on_piece_moved(self, engine: TetrisEngine) -> None:
+        # Only the cells the piece left and the ones it covers now change
+        cells = engine.get_piece_cells()
+        for x, y in self.piece_cells - cells:
+            self.screen.set_at((self.offset_x + x, y), engine.board_colors[y][x])
+
+        for x, y in cells:
+            self.screen.set_at((self.offset_x + x, y), engine.current_piece.color)
+
+        self.piece_cells = cells
+
+    def on_rows_moved(self, engine: TetrisEngine, from_row: int) -> None:
+        for y in range(from_row, engine.board_h):
+            for x in range(engine.board_w):
+                self.screen.set_at((self.offset_x + x, y), engine.board_colors[y][x])
+
+    def on_board_reset(self, engine: TetrisEngine) -> None:
+        self.on_rows_moved(engine, 0)
+        self.piece_cells = set()
+        self.on_piece_moved(engine)
+
+    def on_game_over(self, engine: TetrisEngine) -> None:
+        if self.game_over_callback is not None:
+            self.game_over_callback(engine)
+
+
+def replay(data: dict, listener=None) -> int:
+    # Plays a game from get_replay() again and returns its score
+    engine = TetrisEngine(data["seed"], data.get("board_w", BOARD_W), data.get("board_h", BOARD_H), listener)
+    seed = engine.seed
+
+    for key in data["inputs"]:
+        if engine.seed != seed:
+            raise ValueError("Tetris replay goes on after its game ended")
+
+        engine.apply_input(key)
+
+    if engine.seed != seed:
+        return engine.last_score
+
+    return engine.score
+
+
+def simulate_games(games: int, steps: int, seed: int = 0) -> list[int]:
+    # Scores of `games` games of `steps` random inputs each, all derived from `seed`
+    inputs_random = random.Random(seed)
+    keys = (INPUT_LEFT, INPUT_RIGHT, INPUT_ROTATE, INPUT_DOWN, INPUT_GRAVITY, INPUT_GRAVITY)
+    scores = []
+
+    for _ in range(games):
+        engine = TetrisEngine(inputs_random.getrandbits(32))
+        best_score = 0
+
+        for _ in range(steps):
+            engine.apply_input(inputs_random.choice(keys))
+            best_score = max(best_score, engine.score)
+
+        scores.append(best_score)
+
+    return scores
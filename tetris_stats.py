@@ -0,0 +1,127 @@
+import bisect
+import json
+import os
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.logger import Logger
+
+# Persistent tetris statistics per player name: best score, lines, games played and pieces per minute
+# Stats live in memory, a game end only updates them. What changed is written to the file in one batch every
+# STATS_FLUSH_INTERVAL secs by a thread, so the reactor never waits on the disk. Best scores are kept in a sorted index for /tetris_top
+
+STATS_FILE = "tetris_stats.json"
+STATS_FLUSH_INTERVAL = 30  # Secs between two writes of the stats file, only if a game ended since
+
+log = Logger()
+
+
+class TetrisStats:
+    def __init__(self, file_path: str = STATS_FILE) -> None:
+        self.file_path = file_path
+
+        # name -> {"best_score", "lines", "games", "pieces", "play_secs"}
+        self.players: dict[str, dict] = {}
+        self.ranking: list[tuple[int, str]] = []  # (-best score, name), sorted
+
+        self.dirty = False
+        self.writing = None  # Deferred of the write in progress
+
+        self.loop = LoopingCall(self.flush)
+
+    def load(self) -> None:
+        # Only when the script is loaded, before any game
+        try:
+            with open(self.file_path, "r") as file:
+                players = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        self.players = players
+        self.ranking = sorted((-stats["best_score"], name) for name, stats in players.items())
+
+    def record_game(self, name: str, game, step_interval: float) -> None:
+        # `game` is a TetrisEngine whose gravity steps were `step_interval` secs apart
+        stats = self.players.get(name)
+        if stats is None:
+            stats = self.players[name] = {"best_score": 0, "lines": 0, "games": 0, "pieces": 0, "play_secs": 0.0}
+            bisect.insort(self.ranking, (0, name))
+
+        if game.score > stats["best_score"]:
+            del self.ranking[bisect.bisect_left(self.ranking, (-stats["best_score"], name))]
+            stats["best_score"] = game.score
+            bisect.insort(self.ranking, (-game.score, name))
+
+        stats["lines"] += game.lines
+        stats["games"] += 1
+        stats["pieces"] += game.pieces
+        stats["play_secs"] += game.steps * step_interval
+
+        self.dirty = True
+        if not self.loop.running:
+            self.loop.start(STATS_FLUSH_INTERVAL, now=False)
+
+    def get_top(self, count: int) -> list[tuple[str, dict]]:
+        return [(name, self.players[name]) for _, name in self.ranking[:count]]
+
+    def get_rank(self, name: str) -> int:
+        stats = self.players.get(name)
+        if stats is None:
+            return None
+
+        return bisect.bisect_left(self.ranking, (-stats["best_score"], name)) + 1
+
+    def get_pieces_per_minute(self, stats: dict) -> float:
+        if stats["play_secs"] <= 0:
+            return 0.0
+
+        return stats["pieces"] * 60 / stats["play_secs"]
+
+    def flush(self):
+        if self.writing is not None:
+            return self.writing
+
+        if not self.dirty:
+            # Started again by the next game end
+            if self.loop.running:
+                self.loop.stop()
+            return None
+
+        # Copied on the reactor thread, the games keep updating the stats while the thread writes
+        players = {name: dict(stats) for name, stats in self.players.items()}
+        self.dirty = False
+
+        self.writing = deferToThread(self.write, players)
+        self.writing.addErrback(self.on_write_failed)
+        self.writing.addBoth(self.on_written)
+        return self.writing
+
+    def write(self, players: dict) -> None:
+        tmp_path = self.file_path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(players, file, indent=4)
+
+        os.replace(tmp_path, self.file_path)
+
+    def on_write_failed(self, failure) -> None:
+        # Tried again with the next flush
+        log.failure("Couldn't write the tetris stats", failure)
+        self.dirty = True
+
+    def on_written(self, result) -> None:
+        self.writing = None
+
+    def close(self):
+        # Waits for a write in progress, then writes what changed during it
+        if self.writing is not None:
+            return self.writing.addCallback(lambda _: self.flush())
+
+        return self.flush()
+
+
+tetris_stats = TetrisStats()
+tetris_stats.load()
+
+# The last games are written before the server stops, twisted waits for the returned deferred
+reactor.addSystemEventTrigger("before", "shutdown", tetris_stats.close)